@@ -4,6 +4,8 @@ import matplotlib.pyplot as plt
 from matplotlib.cm import Dark2
 import os
 
+from stage_profiler import report, stage
+
 def extract_cif_info_by_chain(cif_file):
     # Read the CIF file
     structure = gemmi.read_structure(cif_file)
@@ -92,12 +94,18 @@ def process_cif_files(input_folder, output_folder):
         cif_path = os.path.join(input_folder, cif_file)
         base_filename = os.path.splitext(cif_file)[0]
 
-        chain_info = extract_cif_info_by_chain(cif_path)
-        output_csv_by_chain(chain_info, output_folder, base_filename)
-        plot_b_factors_by_chain(chain_info, output_folder, base_filename)
-
-# Example usage
-input_folder = "input_folder/cifs"
-output_folder = "output_folder/cifs"
-
-process_cif_files(input_folder, output_folder)
+        with stage("read", file=cif_path) as record:
+            chain_info = extract_cif_info_by_chain(cif_path)
+            record["rows"] = sum(len(data["residue_info"]) for data in chain_info.values())
+        with stage("write", rows=record["rows"]):
+            output_csv_by_chain(chain_info, output_folder, base_filename)
+        with stage("plot"):
+            plot_b_factors_by_chain(chain_info, output_folder, base_filename)
+
+if __name__ == "__main__":
+    # Example usage
+    input_folder = "input_folder/cifs"
+    output_folder = "output_folder/cifs"
+
+    process_cif_files(input_folder, output_folder)
+    report(os.path.join(output_folder, "stage_profile.json"))
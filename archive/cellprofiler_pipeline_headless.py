@@ -1,6 +1,14 @@
 """
 Run the premade cellprofiler pipeline in batches over the images provided.
 
+Each worker process starts Java and loads the pipeline once, then pulls batches of
+image sets from a shared queue until it runs out of work, so the JVM startup and
+pipeline load are paid once per worker rather than once per folder.
+
+Completed folders/shards are recorded in a checkpoint ledger with the checksums of their
+outputs, so a rerun after a crash only does the work that is missing. Workers that hang
+are killed after TASK_TIMEOUT and their task retried.
+
 Cellprofiler needs python 3.8 to run.
 """
 
@@ -8,80 +16,505 @@ import cellprofiler_core.pipeline
 import cellprofiler_core.preferences
 import cellprofiler_core.utilities.java
 import cellprofiler.modules
+import csv
+import hashlib
+import json
+import multiprocessing
 import os
 import pathlib
+import queue
+import re
+import shutil
+import time
 
-from multiprocessing import Pool
-from typing import List
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 
 # Set params below
 OUTPUT_SETTING_NUMBER = 8
 NUM_WORKERS = 8
 PIPELINE_PATH = ""
 INPUT_FOLDERS: List[str] = ["", ""]
+# Number of image sets per task. None runs each folder as a single task, otherwise each
+# batch is exported to its own part_XXX subfolder of the folder's output and merged back
+# once everything has run.
+IMAGES_PER_BATCH: Optional[int] = None
+# Alternatively, split every folder into this many shards (overrides IMAGES_PER_BATCH).
+NUM_SHARDS: Optional[int] = None
+KEEP_SHARD_OUTPUTS = False
+# Exports with two header rows (ExportToSpreadsheet with several object groups in one file)
+TWO_HEADER_FILES = ["All_measurements.csv"]
+# Exports with one row per run rather than per image, copied from the first shard on merge
+PER_RUN_FILES = ["Experiment.csv"]
+# The export with one row per image, which sets the ImageNumber offset of each shard
+IMAGE_FILE = "Image.csv"
+# Columns renumbered on merge: ImageNumber, and the image references of relationship
+# exports (ImageNumber_First / ImageNumber_Second, or "First Image Number"...)
+IMAGE_NUMBER_COLUMN_PATTERN = r"ImageNumber(_\w+)?|(First|Second) Image Number"
+# Completed folders/shards and their output checksums are appended here, and skipped on
+# a rerun. Delete it to force everything to run again.
+LEDGER_PATH = "output_files/checkpoint_ledger.jsonl"
+TASK_TIMEOUT = 4 * 60 * 60  # seconds before a task's worker (and its JVM) is killed
+MAX_RETRIES = 2
+# Files that match once this is stripped from the name belong to the same image set,
+# e.g. ..._XY1_405.tif and ..._XY1_561.tif
+CHANNEL_SUFFIX_PATTERN = r"_[^_]+\.tif$"
 
+# (output folder, file uris)
+Task = Tuple[str, List[str]]
 
-def run_pipeline(pipeline_path: str, input_folder: str, output_folder: str) -> None:
-    """Within an env with cellprofiler and java running, run the pipeline.
 
-    Args:
-        pipeline_path: path to a cppipe file
-        input_folder: a folder containing tif files
-        output_folder: a folder to save the output to
-    Returns:
-        None, because the cellprofiler_core.measurement._measurements.Measurements object
-            can't be pickled.
-    """
-    print(
-        f"Running pipeline {pipeline_path} on {input_folder} and saving to {output_folder}"
-    )
-    # Start cellprofiler
-    cellprofiler_core.preferences.set_headless()
-    cellprofiler_core.utilities.java.start_java()
-    # Read the pipeline
+def load_pipeline(pipeline_path: str) -> cellprofiler_core.pipeline.Pipeline:
+    """Within an env with cellprofiler and java running, load the pipeline."""
     pipeline = cellprofiler_core.pipeline.Pipeline()
     pipeline.load(pipeline_path)
-
-    # set the output directory (this is quite brittle)
+    # check that the output directory is where we expect it (this is quite brittle)
     export_module = pipeline.modules()[-1]
     assert isinstance(
         export_module, cellprofiler.modules.exporttospreadsheet.ExportToSpreadsheet
     )
-
     export_file_directory = export_module.setting(OUTPUT_SETTING_NUMBER)
     assert (
         export_file_directory.to_dict()["text"] == "Output file location"
     ), export_file_directory.to_dict()["text"]
-    export_file_directory.set_value(f"Elsewhere...|{output_folder}")
-    # Load the images
-    file_list = list(pathlib.Path(".").absolute().glob(f"{input_folder}/*.tif"))
-    assert file_list  # check that the glob found some files
-    files = [file.as_uri() for file in file_list]
+    return pipeline
+
+
+def run_pipeline(
+    pipeline: cellprofiler_core.pipeline.Pipeline, files: List[str], output_folder: str
+) -> None:
+    """Run an already loaded pipeline over a list of files.
+
+    Args:
+        pipeline: a pipeline from load_pipeline
+        files: uris of the tif files to process
+        output_folder: a folder to save the output to
+    Returns:
+        None, because the cellprofiler_core.measurement._measurements.Measurements object
+            can't be pickled.
+    """
+    print(f"Running pipeline on {len(files)} files and saving to {output_folder}")
+    export_module = pipeline.modules()[-1]
+    export_module.setting(OUTPUT_SETTING_NUMBER).set_value(
+        f"Elsewhere...|{output_folder}"
+    )
+    pipeline.clear_urls(add_undo=False)
     pipeline.read_file_list(files)
     # Run, discard output
     _ = pipeline.run()
-    # Need to stop the Java VM otherwise it will hang
-    cellprofiler_core.utilities.java.stop_java()
     return None
 
 
+def group_image_sets(input_folder: str) -> List[List[str]]:
+    """Find the tif files in a folder and group them into image sets (one per field)."""
+    file_list = sorted(pathlib.Path(".").absolute().glob(f"{input_folder}/*.tif"))
+    assert file_list  # check that the glob found some files
+    image_sets = defaultdict(list)
+    for file in file_list:
+        image_sets[_image_set_name(file.name)].append(file.as_uri())
+    return list(image_sets.values())
+
+
+def count_image_sets(files: List[str]) -> int:
+    """The number of image sets (and so of CellProfiler images) in a task's file uris."""
+    return len({_image_set_name(uri.rsplit("/", 1)[-1]) for uri in files})
+
+
+def _image_set_name(file_name: str) -> str:
+    return re.sub(CHANNEL_SUFFIX_PATTERN, "", file_name)
+
+
+def split_into_shards(image_sets: List[List[str]], num_shards: int) -> List[List[str]]:
+    """Split image sets into num_shards contiguous shards of near-equal size, keeping order."""
+    num_shards = min(num_shards, len(image_sets))
+    bounds = [len(image_sets) * i // num_shards for i in range(num_shards + 1)]
+    return [
+        [f for image_set in image_sets[start:stop] for f in image_set]
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def make_tasks(
+    input_folder: str,
+    output_folder: str,
+    images_per_batch: Optional[int] = None,
+    num_shards: Optional[int] = None,
+) -> List[Task]:
+    """Split the image sets in a folder into tasks.
+
+    Args:
+        input_folder: a folder containing tif files
+        output_folder: a folder to save the output to
+        images_per_batch: at most this many image sets per task
+        num_shards: split into this many tasks instead. Takes precedence over images_per_batch.
+    Returns:
+        (output folder, file uris) for each task. If the folder is split, each task
+            exports to output_folder/part_XXX, to be merged with merge_shards.
+    """
+    image_sets = group_image_sets(input_folder)
+    if num_shards is None and images_per_batch is not None:
+        num_shards = -(-len(image_sets) // images_per_batch)
+    if num_shards is None or num_shards <= 1 or len(image_sets) == 1:
+        return [(output_folder, [f for image_set in image_sets for f in image_set])]
+    return [
+        (os.path.join(output_folder, f"part_{shard_number:03d}"), files)
+        for shard_number, files in enumerate(split_into_shards(image_sets, num_shards))
+    ]
+
+
+def load_ledger(ledger_path: str) -> Dict[str, dict]:
+    """Read the checkpoint ledger: the latest entry for each completed output folder."""
+    ledger = {}
+    if os.path.exists(ledger_path):
+        with open(ledger_path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    ledger[entry["output_folder"]] = entry
+    return ledger
+
+
+def _hash_inputs(files: List[str]) -> str:
+    return hashlib.sha256("\n".join(sorted(files)).encode()).hexdigest()
+
+
+def _checksum_outputs(output_folder: str) -> Dict[str, str]:
+    """sha256 of each csv exported to output_folder."""
+    checksums = {}
+    for csv_path in sorted(pathlib.Path(output_folder).glob("*.csv")):
+        sha = hashlib.sha256()
+        with open(csv_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        checksums[csv_path.name] = sha.hexdigest()
+    return checksums
+
+
+def is_complete(ledger: Dict[str, dict], output_folder: str, files: List[str]) -> bool:
+    """Whether the ledger says output_folder was made from exactly these files, and the
+    outputs on disk still match the recorded checksums."""
+    entry = ledger.get(output_folder)
+    return (
+        entry is not None
+        and entry["inputs"] == _hash_inputs(files)
+        and bool(entry["outputs"])
+        and entry["outputs"] == _checksum_outputs(output_folder)
+    )
+
+
+def record_completion(ledger_path: str, output_folder: str, files: List[str]) -> None:
+    """Append a completed output folder, with its output checksums, to the ledger."""
+    entry = {
+        "output_folder": output_folder,
+        "inputs": _hash_inputs(files),
+        "outputs": _checksum_outputs(output_folder),
+        "completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    os.makedirs(os.path.dirname(ledger_path) or ".", exist_ok=True)
+    with open(ledger_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def worker_loop(
+    worker_id: int,
+    pipeline_path: str,
+    task_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue,
+    claimed_task,
+) -> None:
+    """Start java and load the pipeline once, then run tasks until a None arrives.
+
+    Reports ("started", worker_id, task_index, error) and ("finished", ...) for each
+    task, so that the parent can spot stuck workers. The index of the current task is
+    also kept in claimed_task (a shared multiprocessing.Value, -1 when idle), which is
+    set as soon as the task is taken: if the worker dies before its "started" message
+    gets through, the parent still knows which task to retry.
+    """
+    cellprofiler_core.preferences.set_headless()
+    cellprofiler_core.utilities.java.start_java()
+    try:
+        pipeline = load_pipeline(pipeline_path)
+        for task_index, output_folder, files in iter(task_queue.get, None):
+            claimed_task.value = task_index
+            result_queue.put(("started", worker_id, task_index, None))
+            try:
+                run_pipeline(pipeline, files, output_folder)
+                result_queue.put(("finished", worker_id, task_index, None))
+            except Exception as e:
+                result_queue.put(("finished", worker_id, task_index, repr(e)))
+            claimed_task.value = -1
+    finally:
+        # Need to stop the Java VM otherwise it will hang
+        cellprofiler_core.utilities.java.stop_java()
+
+
+def run_worker_pool(
+    pipeline_path: str,
+    tasks: List[Task],
+    num_workers: int = NUM_WORKERS,
+    ledger_path: str = LEDGER_PATH,
+    task_timeout: float = TASK_TIMEOUT,
+    max_retries: int = MAX_RETRIES,
+) -> List[Task]:
+    """Run all tasks over a pool of long-lived workers fed from a shared queue.
+
+    Tasks already recorded in the ledger are skipped, and each completed task is recorded.
+    A worker that takes longer than task_timeout seconds on a task (or dies) is killed and
+    replaced, and its task is requeued up to max_retries times. Workers that die without
+    a task (e.g. while starting java) are replaced too, unless that keeps happening, in
+    which case every unfinished task fails. All workers are stopped before returning.
+
+    Returns:
+        the tasks that failed.
+    """
+    ledger = load_ledger(ledger_path)
+    todo = [task for task in tasks if not is_complete(ledger, *task)]
+    print(f"{len(tasks) - len(todo)} of {len(tasks)} tasks already complete, skipping")
+    if not todo:
+        return []
+    # biggest tasks first so that stragglers are small
+    todo.sort(key=lambda task: len(task[1]), reverse=True)
+
+    task_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    for task_index, (output_folder, files) in enumerate(todo):
+        task_queue.put((task_index, output_folder, files))
+
+    def start_worker(worker_id):
+        claimed_tasks[worker_id] = multiprocessing.Value("i", -1)
+        worker = multiprocessing.Process(
+            target=worker_loop,
+            args=(
+                worker_id,
+                pipeline_path,
+                task_queue,
+                result_queue,
+                claimed_tasks[worker_id],
+            ),
+        )
+        worker.start()
+        return worker
+
+    claimed_tasks = {}
+    workers = {i: start_worker(i) for i in range(min(num_workers, len(todo)))}
+    # worker_id -> (task_index, start time)
+    in_flight: Dict[int, Tuple[int, float]] = {}
+    attempts = defaultdict(int)
+    failures = {}
+    completed = set()
+    remaining = len(todo)
+    next_worker_id = len(workers)
+    idle_deaths = 0
+    max_idle_deaths = max_retries * len(workers)
+
+    def retry_or_fail(task_index, error):
+        nonlocal remaining
+        attempts[task_index] += 1
+        if attempts[task_index] <= max_retries:
+            print(f"retrying {todo[task_index][0]} after: {error}")
+            task_queue.put((task_index, *todo[task_index]))
+        else:
+            failures[task_index] = error
+            remaining -= 1
+
+    def handle_message(status, worker_id, task_index, error):
+        nonlocal remaining
+        if worker_id not in workers:
+            pass  # a late message from a worker we already killed
+        elif status == "started":
+            in_flight[worker_id] = (task_index, time.monotonic())
+        elif error is not None:
+            in_flight.pop(worker_id, None)
+            retry_or_fail(task_index, error)
+        else:
+            in_flight.pop(worker_id, None)
+            output_folder, files = todo[task_index]
+            record_completion(ledger_path, output_folder, files)
+            completed.add(task_index)
+            remaining -= 1
+            print(f"finished {output_folder}, {remaining} tasks remaining")
+
+    try:
+        while remaining:
+            # everything that has arrived, before looking at which workers are alive
+            try:
+                handle_message(*result_queue.get(timeout=5))
+                while True:
+                    handle_message(*result_queue.get_nowait())
+            except queue.Empty:
+                pass
+            # kill and replace stuck or dead workers
+            for worker_id, worker in list(workers.items()):
+                task_index, started = in_flight.get(worker_id, (None, None))
+                if worker.is_alive():
+                    if task_index is None or time.monotonic() - started < task_timeout:
+                        continue
+                    worker.kill()
+                    error = f"timed out after {task_timeout}s"
+                else:
+                    error = f"worker died with exit code {worker.exitcode}"
+                    if task_index is None:
+                        # it may have taken a task without its "started" getting through
+                        task_index = claimed_tasks[worker_id].value
+                        if task_index < 0 or task_index in completed:
+                            task_index = None
+                worker.join()
+                del workers[worker_id]
+                in_flight.pop(worker_id, None)
+                if task_index is not None:
+                    retry_or_fail(task_index, error)
+                else:
+                    idle_deaths += 1
+                    print(f"worker {worker_id} lost without a task: {error}")
+                    if idle_deaths > max_idle_deaths:
+                        for task_index in range(len(todo)):
+                            if task_index not in completed:
+                                failures.setdefault(
+                                    task_index, f"workers keep dying, last: {error}"
+                                )
+                        remaining = 0
+                        break
+                if remaining:
+                    workers[next_worker_id] = start_worker(next_worker_id)
+                    next_worker_id += 1
+
+        for _ in workers:
+            task_queue.put(None)
+        for worker in workers.values():
+            worker.join(timeout=60)
+    finally:
+        for worker in workers.values():
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    for task_index, error in failures.items():
+        print(f"FAILED {todo[task_index][0]}: {error}")
+    return [todo[task_index] for task_index in failures]
+
+
+def merge_shards(
+    output_folder: str,
+    images_per_shard: List[int],
+    keep_shards: bool = KEEP_SHARD_OUTPUTS,
+) -> None:
+    """Merge the part_XXX exports in output_folder back into single files.
+
+    ImageNumber (and every IMAGE_NUMBER_COLUMN_PATTERN column) is offset by the number
+    of images in the preceding shards, as numbered by CellProfiler in their IMAGE_FILE.
+    ObjectNumber (and Parent_/Children_ columns) count from 1 within each image in
+    CellProfiler, so they stay valid once ImageNumber is renumbered. PER_RUN_FILES are
+    copied from the first shard.
+
+    Args:
+        output_folder: the folder holding the part_XXX subfolders
+        images_per_shard: the number of image sets each shard was given, in shard order,
+            from count_image_sets. Checked against what CellProfiler numbered, so that a
+            pipeline grouping the images differently fails rather than merging wrongly.
+        keep_shards: keep the part_XXX subfolders after merging
+    """
+    shard_folders = sorted(pathlib.Path(output_folder).glob("part_[0-9][0-9][0-9]"))
+    if not shard_folders:
+        return
+    assert len(shard_folders) == len(images_per_shard), (
+        f"{len(shard_folders)} shards in {output_folder}, "
+        f"expected {len(images_per_shard)}"
+    )
+    image_offsets = [0]
+    for shard_folder, num_image_sets in zip(shard_folders, images_per_shard):
+        num_images = _count_images(shard_folder)
+        assert num_images == num_image_sets, (
+            f"CellProfiler numbered {num_images} images in {shard_folder}, but it was "
+            f"given {num_image_sets} image sets. Check CHANNEL_SUFFIX_PATTERN."
+        )
+        image_offsets.append(image_offsets[-1] + num_images)
+    for csv_name in sorted(p.name for p in shard_folders[0].glob("*.csv")):
+        output_path = os.path.join(output_folder, csv_name)
+        if csv_name in PER_RUN_FILES:
+            shutil.copyfile(shard_folders[0] / csv_name, output_path)
+            continue
+        print(f"merging {len(shard_folders)} shards into {output_path}")
+        with open(output_path, "w", newline="") as output_file:
+            writer = csv.writer(output_file)
+            for shard_number, shard_folder in enumerate(shard_folders):
+                image_offset = image_offsets[shard_number]
+                with open(shard_folder / csv_name, newline="") as shard_file:
+                    reader = csv.reader(shard_file)
+                    header, image_cols = _read_header(reader, csv_name)
+                    if shard_number == 0:
+                        writer.writerows(header)
+                    for row in reader:
+                        for i in image_cols:
+                            if row[i]:
+                                row[i] = str(int(row[i]) + image_offset)
+                        writer.writerow(row)
+    if not keep_shards:
+        for shard_folder in shard_folders:
+            shutil.rmtree(shard_folder)
+
+
+def _read_header(reader, csv_name: str) -> Tuple[List[List[str]], List[int]]:
+    """Read the header row(s) of an export, and find the ImageNumber columns."""
+    num_header_rows = 2 if csv_name in TWO_HEADER_FILES else 1
+    header = [next(reader) for _ in range(num_header_rows)]
+    image_cols = [
+        i
+        for i, name in enumerate(header[-1])
+        if re.fullmatch(IMAGE_NUMBER_COLUMN_PATTERN, name)
+    ]
+    return header, image_cols
+
+
+def _count_images(shard_folder: pathlib.Path) -> int:
+    """The number of images CellProfiler processed in a shard: the largest ImageNumber in
+    its IMAGE_FILE, which has a row for every image."""
+    image_path = shard_folder / IMAGE_FILE
+    if not image_path.exists():
+        raise FileNotFoundError(
+            f"{image_path} is needed to renumber the images. Export it, or set IMAGE_FILE"
+        )
+    with open(image_path, newline="") as f:
+        reader = csv.reader(f)
+        header, _ = _read_header(reader, IMAGE_FILE)
+        image_col = header[-1].index("ImageNumber")
+        return max((int(row[image_col]) for row in reader), default=0)
+
+
 if __name__ == "__main__":
     input_folders = [f"input_files/{x}" for x in INPUT_FOLDERS]
+    ledger = load_ledger(LEDGER_PATH)
+    tasks = []
+    # output folder -> all of its input files, and the number of image sets per shard
+    sharded_folders = {}
     for input_folder in input_folders:
-        # for each subfolder in the input folder, run the pipeline.
-        print("running analysis for: ", input_folder)
+        # for each subfolder in the input folder, queue up the pipeline.
+        print("queueing analysis for: ", input_folder)
         subfolders = [f.path for f in os.scandir(input_folder) if f.is_dir()]
-        with Pool(
-            NUM_WORKERS
-        ) as p:  # parallelise - pool is limited by number of subfolders
-            p.starmap(
-                run_pipeline,
-                [
-                    (
-                        PIPELINE_PATH,
-                        subfolder,
-                        subfolder.replace("input_files", "output_files"),
-                    )
-                    for subfolder in subfolders
-                ],
+        for subfolder in subfolders:
+            output_folder = subfolder.replace("input_files", "output_files")
+            folder_tasks = make_tasks(
+                subfolder, output_folder, IMAGES_PER_BATCH, NUM_SHARDS
             )
+            folder_files = [f for _, files in folder_tasks for f in files]
+            if len(folder_tasks) > 1:
+                if is_complete(ledger, output_folder, folder_files):
+                    print(f"{output_folder} already merged, skipping")
+                    continue
+                sharded_folders[output_folder] = (
+                    folder_files,
+                    [count_image_sets(files) for _, files in folder_tasks],
+                )
+            tasks.extend(folder_tasks)
+    failed_tasks = run_worker_pool(PIPELINE_PATH, tasks)
+    # stitch the sharded folders back together for cellprofiler_output_analyser.py
+    failed_folders = {
+        os.path.dirname(output_folder) for output_folder, _ in failed_tasks
+    }
+    for output_folder, (folder_files, images_per_shard) in sharded_folders.items():
+        if output_folder in failed_folders:
+            print(f"not merging {output_folder}, some shards failed")
+            continue
+        merge_shards(output_folder, images_per_shard)
+        record_completion(LEDGER_PATH, output_folder, folder_files)
@@ -13,6 +13,8 @@ from count_total_and_mean_edge_spots import *
 DO_PLOT = False
 SLICE_INDEX_START = 45  # 13
 SLICE_INDEX_STOP = 48  # 16
+# time between timepoints, to convert T01, T02... to minutes
+FRAME_INTERVAL_MINUTES = 40
 IMPORTANT_COLUMNS = [
     "Intensity_MassDisplacement_MIRO160mer",
     "Intensity_MassDisplacement_mito",
@@ -66,11 +68,10 @@ for input_path in INPUT_PATHS:
         pivot_df = pd.DataFrame.from_dict(new_array_dict)
 
         # relabel the median dictionary and normalise by the first value
-        median_dict_normalised = {}
         print(median_dict.keys())
-        for key, value in median_dict.items():
-            minute = (int(key[1:]) - 1) * 40  # this 15 should be changed
-            median_dict_normalised[minute] = median_dict[key] / median_dict["T01"]
+        medians = pd.Series(median_dict)
+        minutes = (medians.index.str[1:].astype(int) - 1) * FRAME_INTERVAL_MINUTES
+        median_dict_normalised = dict(zip(minutes, medians / median_dict["T01"]))
 
         # put in our stitched dictionary
         condition = input_path.split("/")[1]
@@ -140,10 +141,9 @@ for input_path in glob.glob("230118/*/Perinuclear_region.csv"):
         pivot_df = pd.DataFrame.from_dict(new_array_dict)
 
         # relabel the median dictionary and normalise by the first value
-        median_dict_normalised = {}
-        for key, value in median_dict.items():
-            minute = (int(key[1:]) - 1) * 40  # this 15 should be changed
-            median_dict_normalised[minute] = median_dict[key] / median_dict["T01"]
+        medians = pd.Series(median_dict)
+        minutes = (medians.index.str[1:].astype(int) - 1) * FRAME_INTERVAL_MINUTES
+        median_dict_normalised = dict(zip(minutes, medians / median_dict["T01"]))
 
         # put in our stitched dictionary
         condition = input_path.split("/")[1]
@@ -4,38 +4,157 @@ nd2_file_analyser.py
 
 For all nd2 files in a given folder:
 
-1. Read the nd2 file. It is a set of 2d images specified by channels, times, z coords and position (in the well)
-2. Max-project along the z dimension
-3. Adjust intensity with visual inspection ?!
-4. Export a set of .tiff files for CellProfiler, or run CP-equivalent analysis in Python.
+1. Read the nd2 file lazily. It is a set of 2d images specified by channels, times, z coords
+   and position (in the well)
+2. Max-project along the z dimension, one (T, position, channel) z-stack at a time, so that
+   only a single stack is ever in memory per worker.
+3. Export a .tif file for each projected plane for CellProfiler, named so that
+   extract_wellnumber / extract_xy / extract_timestamp can read the metadata back:
+
+       <nd2 name>_Well<well>_XY<position>_T<time>_<channel>.tif
+
+Positions are processed in parallel, each worker opening its own handle on the nd2 file.
 """
 
-import napari
 import nd2
+import numpy as np
 import os
+import re
+import tifffile
 
-
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
+from typing import Dict, Iterator, List, Optional, Tuple
 
 FOLDER_PATH = os.getcwd()
+OUTPUT_FOLDER = os.path.join(FOLDER_PATH, "tifs")
+NUM_WORKERS = 8
+
+
+def sanitise(name: str) -> str:
+    """Make a channel/position name safe to use in the filenames (no underscores)."""
+    return re.sub(r"[^A-Za-z0-9,.-]+", "-", name).strip("-")
+
+
+def get_position_names(nd2_file: nd2.ND2File) -> List[Optional[str]]:
+    """The name of each XY position, if the experiment recorded them."""
+    num_positions = nd2_file.sizes.get("P", 1)
+    for loop in nd2_file.experiment:
+        if loop.type == "XYPosLoop":
+            names = [point.name for point in loop.parameters.points]
+            if len(names) == num_positions:
+                return names
+    return [None] * num_positions
+
+
+def get_channel_names(nd2_file: nd2.ND2File) -> List[str]:
+    num_channels = nd2_file.sizes.get("C", 1)
+    try:
+        names = [sanitise(c.channel.name) for c in nd2_file.metadata.channels]
+    except (AttributeError, TypeError):
+        names = []
+    if len(names) != num_channels:
+        names = [f"ch{c}" for c in range(num_channels)]
+    return names
+
+
+def get_well(stem: str, position_name: Optional[str]) -> Optional[str]:
+    """The well, from the nd2 filename if it has one, otherwise from the position name."""
+    well_match = re.search(r"Well([A-Z]\d+)", stem)
+    if well_match is not None:
+        return well_match.group(1)
+    if position_name and re.fullmatch(r"[A-Z]\d+", position_name):
+        return position_name
+    return None
+
 
-print(f"reading files in {FOLDER_PATH}")
-for nd2_filepath in glob(f"{FOLDER_PATH}/*.nd2"):
-    print("processing", nd2_filepath)
+def plane_filename(
+    stem: str, well: Optional[str], xy: int, t: int, channel: str
+) -> str:
+    """Filename following the conventions of the CellProfiler output analysers."""
+    if well is not None and re.search(r"Well[A-Z]\d+", stem) is None:
+        stem = f"{stem}_Well{well}"
+    return f"{stem}_XY{xy}_T{t:03d}_{channel}.tif"
+
+
+def iter_projected_planes(
+    nd2_file: nd2.ND2File, position: int
+) -> Iterator[Tuple[int, str, np.ndarray]]:
+    """Lazily yield (t, channel name, z max-projected plane) for one XY position.
+
+    Each (T, P) stack is read and projected once for all channels, then split by channel,
+    so the frames (which hold every channel) are not read again for each channel.
+    """
+    sizes: Dict[str, int] = nd2_file.sizes
+    dims = list(sizes)
+    channel_names = get_channel_names(nd2_file)
+    nd2_array = nd2_file.to_dask()  # lazy, nothing is read until computed
+    remaining_dims = [d for d in dims if d not in ("T", "P")]
+    for t in range(sizes.get("T", 1)):
+        index = tuple({"T": t, "P": position}.get(dim, slice(None)) for dim in dims)
+        stack = nd2_array[index]
+        stack_dims = remaining_dims
+        if "Z" in stack_dims:
+            stack = stack.max(axis=stack_dims.index("Z"))
+            stack_dims = [d for d in stack_dims if d != "Z"]
+        projection = np.asarray(stack.compute(scheduler="synchronous"))
+        if "C" not in stack_dims:
+            yield t, channel_names[0], projection
+            continue
+        channel_axis = stack_dims.index("C")
+        for c, channel in enumerate(channel_names):
+            yield t, channel, np.take(projection, c, axis=channel_axis)
+
+
+def project_position(nd2_filepath: str, position: int, output_folder: str) -> int:
+    """Max-project and export every (T, channel) plane of one XY position.
+
+    Returns the number of files written.
+    """
+    stem = os.path.splitext(os.path.basename(nd2_filepath))[0]
+    count = 0
     with nd2.ND2File(nd2_filepath) as nd2_file:
-        print(nd2_file.sizes)
-        print(nd2_file.shape)
+        well = get_well(stem, get_position_names(nd2_file)[position])
+        for t, channel, plane in iter_projected_planes(nd2_file, position):
+            tifffile.imwrite(
+                os.path.join(
+                    output_folder,
+                    plane_filename(stem, well, position + 1, t + 1, channel),
+                ),
+                plane,
+            )
+            count += 1
+    return count
+
+
+def preprocess_nd2(
+    nd2_filepath: str, output_folder: str, num_workers: int = NUM_WORKERS
+) -> int:
+    """Write CellProfiler-ready max projections for every plane of an nd2 file.
 
-        print(dir(nd2))
-        print(dir(nd2_file))
-        nd2_array = nd2_file.to_dask()
-        # # max project
-        zmax = nd2_array.max(
-            axis=2
-        )  # run some asserts and checks to make sure 2 is the correct axis.
-        print(dir(nd2_array))
+    Returns the number of files written.
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    with nd2.ND2File(nd2_filepath) as nd2_file:
+        print(nd2_file.sizes)
+        num_positions = nd2_file.sizes.get("P", 1)
+    with ProcessPoolExecutor(min(num_workers, num_positions)) as executor:
+        counts = executor.map(
+            project_position,
+            [nd2_filepath] * num_positions,
+            range(num_positions),
+            [output_folder] * num_positions,
+        )
+        return sum(counts)
 
-        print(zmax.shape)
 
-        # viewer = napari.view_image(zmax, channel_axis=2, ndisplay=3)
-        # napari.run()
+if __name__ == "__main__":
+    print(f"reading files in {FOLDER_PATH}")
+    for nd2_filepath in glob(f"{FOLDER_PATH}/*.nd2"):
+        print("processing", nd2_filepath)
+        output_folder = os.path.join(
+            OUTPUT_FOLDER, os.path.splitext(os.path.basename(nd2_filepath))[0]
+        )
+        num_files = preprocess_nd2(nd2_filepath, output_folder)
+        print(f"wrote {num_files} files to {output_folder}")
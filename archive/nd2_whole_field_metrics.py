@@ -0,0 +1,89 @@
+"""
+nd2_whole_field_metrics.py
+
+Segmentation-free QC fast path: for all nd2 files in a given folder, compute the Gini,
+CoV and mean intensity of each max-projected field straight from the lazily loaded nd2
+arrays, without writing TIFFs or running CellProfiler.
+
+Output is a tidy table with one row per (WellNumber, XY, T, channel), as in the
+intermediates from cellprofiler_output_analyser.py:
+
+    | WellNumber | XY | T | channel | mean_intensity | CoV | Gini |
+"""
+
+import nd2
+import numpy as np
+import os
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from typing import Dict, List
+
+from nd2_file_analyser import get_position_names, get_well, iter_projected_planes
+
+FOLDER_PATH = os.getcwd()
+OUTPUT_PATH = os.path.join(FOLDER_PATH, "whole_field_metrics.csv")
+NUM_WORKERS = 8
+
+
+def get_gini_on_pixels(pixels):
+    """Given an array of pixels, get the Gini coefficient
+
+    Copied from mito_motility_2024/calculate_gini.py, which can only be imported
+    from within CellProfiler.
+
+    Assumes intensties are always positive.
+    """
+    flattened = np.sort(np.ravel(pixels)).astype(np.float64)
+    npix = np.size(flattened)
+    normalization = np.abs(np.mean(flattened)) * npix * (npix - 1)
+    kernel = (2.0 * np.arange(1, npix + 1) - npix - 1) * np.abs(flattened)
+
+    return np.sum(kernel) / normalization
+
+
+def position_metrics(nd2_filepath: str, position: int) -> List[Dict[str, object]]:
+    """Compute the whole-field metrics for every (T, channel) plane of one XY position."""
+    stem = os.path.splitext(os.path.basename(nd2_filepath))[0]
+    rows = []
+    with nd2.ND2File(nd2_filepath) as nd2_file:
+        well = get_well(stem, get_position_names(nd2_file)[position])
+        for t, channel, plane in iter_projected_planes(nd2_file, position):
+            mean = plane.mean(dtype=np.float64)
+            rows.append(
+                {
+                    "WellNumber": well,
+                    "XY": position + 1,
+                    "T": t + 1,
+                    "channel": channel,
+                    "mean_intensity": mean,
+                    "CoV": plane.std(dtype=np.float64) / mean,
+                    "Gini": get_gini_on_pixels(plane),
+                }
+            )
+    return rows
+
+
+def nd2_metrics(nd2_filepath: str, num_workers: int = NUM_WORKERS) -> pd.DataFrame:
+    """Whole-field metrics for every plane of an nd2 file, positions in parallel."""
+    with nd2.ND2File(nd2_filepath) as nd2_file:
+        num_positions = nd2_file.sizes.get("P", 1)
+    with ProcessPoolExecutor(min(num_workers, num_positions)) as executor:
+        per_position = executor.map(
+            position_metrics, [nd2_filepath] * num_positions, range(num_positions)
+        )
+        return pd.DataFrame([row for rows in per_position for row in rows])
+
+
+if __name__ == "__main__":
+    print(f"reading files in {FOLDER_PATH}")
+    metrics = []
+    for nd2_filepath in glob(f"{FOLDER_PATH}/*.nd2"):
+        print("processing", nd2_filepath)
+        metrics_df = nd2_metrics(nd2_filepath)
+        metrics_df.insert(0, "file", os.path.basename(nd2_filepath))
+        metrics.append(metrics_df)
+    output_df = pd.concat(metrics, ignore_index=True)
+    print(f"writing metrics with shape {output_df.shape} to {OUTPUT_PATH}")
+    output_df.to_csv(OUTPUT_PATH, index=False)
@@ -43,39 +43,28 @@ def process_cellprofiler_edgespot_df(
     edge_spot_median_intensity_column=EDGE_SPOT_MEDIAN_INTENSITY_COLUMN,
     edge_spot_mean_intensity_column=EDGE_SPOT_MEAN_INTENSITY_COLUMN,
 ) -> pd.DataFrame:
-    """Given a cellprofiler dataframe, extract the data from the filename column."""
-    use_cols = []
+    """Given a cellprofiler dataframe, extract the data from the filename column.
+
+    input_df is left untouched: the output is built from the columns it needs only.
+    """
+    filenames = input_df["Image"][filename_column]
+    columns = {}
     if get_timestamp:
-        input_df["T"] = input_df["Image"][filename_column].apply(extract_timestamp)
-        use_cols.append("T")
+        columns["T"] = filenames.apply(extract_timestamp).to_numpy()
     if get_xy:
-        input_df["XY"] = input_df["Image"][filename_column].apply(extract_xy)
-        use_cols.append("XY")
+        columns["XY"] = filenames.apply(extract_xy).to_numpy()
     if get_wellnumber:
-        input_df["WellNumber"] = input_df["Image"][filename_column].apply(
-            extract_wellnumber
-        )
-        use_cols.append("WellNumber")
-    input_df["nuclei_count"] = input_df["Nuclei"][nuclei_count_column]
-    input_df["edge_spot_count"] = input_df["edge_spots"][edge_spot_count_column]
-    input_df["edge_spot_median_intensity"] = input_df["edge_spots"][
+        columns["WellNumber"] = filenames.apply(extract_wellnumber).to_numpy()
+    columns["nuclei_count"] = input_df["Nuclei"][nuclei_count_column].to_numpy()
+    edge_spots = input_df["edge_spots"]
+    columns["edge_spot_count"] = edge_spots[edge_spot_count_column].to_numpy()
+    columns["edge_spot_median_intensity"] = edge_spots[
         edge_spot_median_intensity_column
-    ]
-    input_df["edge_spot_mean_intensity"] = input_df["edge_spots"][
+    ].to_numpy()
+    columns["edge_spot_mean_intensity"] = edge_spots[
         edge_spot_mean_intensity_column
-    ]
-    use_cols.extend(
-        [
-            "nuclei_count",
-            "edge_spot_count",
-            "edge_spot_median_intensity",
-            "edge_spot_mean_intensity",
-        ]
-    )
-    processed_df = input_df[use_cols].reset_index(drop=True)
-    # drop the bottom of the multiindex to prevent future headaches
-    processed_df.columns = processed_df.columns.droplevel(1)
-    return processed_df
+    ].to_numpy()
+    return pd.DataFrame(columns)
 
 
 def aggregate_edgespot_df(input_df: pd.DataFrame, groupby_vars) -> pd.DataFrame:
@@ -0,0 +1,124 @@
+"""
+benchmark_structures.py
+
+Benchmark the structure scripts on synthetic predictions of increasing size, from
+synthetic_structures.py:
+
+- pdb_aggregator.calculate_average_error on the pdb
+- alphafold_parser.extract_cif_info_by_chain on the mmCIF
+- colabfold_json_to_heatmap.pae_json_to_heatmap on the score json (csv, and the heatmap
+  if PLOT_HEATMAP)
+
+For each script and size, reports the per-file latency, parse throughput (atoms/s for the
+structures, residues/s for the json, and MB/s) and peak RSS. Each measurement runs in a
+fresh process so that the peak RSS is its own. Results go to
+BENCHMARK_FOLDER/structure_benchmark.csv.
+"""
+import multiprocessing
+import os
+import shutil
+import time
+from typing import Dict
+
+import pandas as pd
+
+from synthetic_structures import write_synthetic_prediction
+
+# ----------- CHANGE HERE ---------------
+BENCHMARK_FOLDER = "benchmark_folder/structures"
+SIZES = [500, 1000, 2000, 5000]  # total residues
+NUM_CHAINS = 4
+ATOMS_PER_RESIDUE = 8
+REPEATS = 3
+PLOT_HEATMAP = False
+KEEP_GENERATED_FILES = False
+# ---------------------------------------
+
+SCRIPTS = {
+    "pdb_aggregator": "pdb",
+    "alphafold_parser": "cif",
+    "colabfold_json_to_heatmap": "json",
+}
+
+
+def time_script(script: str, path: str, output_folder: str, repeats: int) -> Dict:
+    """Parse one file `repeats` times with a script. Runs in its own process."""
+    from stage_profiler import peak_rss_mb
+
+    if script == "pdb_aggregator":
+        from pdb_aggregator import calculate_average_error
+
+        def parse():
+            calculate_average_error(path)
+
+    elif script == "alphafold_parser":
+        from alphafold_parser import extract_cif_info_by_chain
+
+        def parse():
+            extract_cif_info_by_chain(path)
+
+    else:
+        from colabfold_json_to_heatmap import pae_json_to_heatmap
+
+        def parse():
+            pae_json_to_heatmap(path, output_folder, plot=PLOT_HEATMAP)
+
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        parse()
+    return {
+        "seconds_per_file": (time.perf_counter() - start) / repeats,
+        "peak_rss_mb": peak_rss_mb(),
+        "high_water_mark_increase_mb": peak_rss_mb() - rss_before,
+    }
+
+
+if __name__ == "__main__":
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for num_residues in SIZES:
+        size_folder = os.path.join(BENCHMARK_FOLDER, str(num_residues))
+        # generated in another process too: on Linux a child starts with the peak RSS
+        # of the process it was forked from
+        with context.Pool(1) as pool:
+            paths = pool.apply(
+                write_synthetic_prediction,
+                (size_folder, num_residues, NUM_CHAINS, ATOMS_PER_RESIDUE),
+            )
+        for script, file_type in SCRIPTS.items():
+            with context.Pool(1) as pool:
+                timing = pool.apply(
+                    time_script, (script, paths[file_type], size_folder, REPEATS)
+                )
+            size_mb = os.path.getsize(paths[file_type]) / 1024**2
+            units = (
+                num_residues
+                if file_type == "json"
+                else num_residues * ATOMS_PER_RESIDUE
+            )
+            result = {
+                "script": script,
+                "residues": num_residues,
+                "file_mb": size_mb,
+                "units": units,
+                "unit": "residues" if file_type == "json" else "atoms",
+                **timing,
+                "units_per_s": units / timing["seconds_per_file"],
+                "mb_per_s": size_mb / timing["seconds_per_file"],
+            }
+            print(
+                f"{script:<26}{num_residues:>6} residues  "
+                f"{timing['seconds_per_file']:8.3f} s/file  "
+                f"{result['units_per_s']:12.0f} {result['unit']}/s  "
+                f"{result['mb_per_s']:8.1f} MB/s  "
+                f"{timing['peak_rss_mb']:8.1f} MB peak"
+            )
+            results.append(result)
+        if not KEEP_GENERATED_FILES:
+            shutil.rmtree(size_folder)
+
+    output_path = os.path.join(BENCHMARK_FOLDER, "structure_benchmark.csv")
+    os.makedirs(BENCHMARK_FOLDER, exist_ok=True)
+    pd.DataFrame(results).to_csv(output_path, index=False)
+    print(f"results written to {output_path}")
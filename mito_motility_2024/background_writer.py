@@ -0,0 +1,101 @@
+"""
+A background writer for the many small CSVs of cellprofiler_output_analyser.py, so that
+computing the next well or folder overlaps with writing the last one, e.g. to a slow
+network share.
+
+    writer = BackgroundWriter(num_threads=4, max_pending=16)
+    writer.submit(df, "output_folder/CoV_static.csv")
+    ...
+    writer.close()  # waits for every write, and checks it
+
+Each frame is serialised and written by a thread pool. At most max_pending frames are
+queued or being written: past that, submit blocks until one finishes, so that a slow
+disk cannot fill the memory with finished frames. Files are written to a temporary name
+and renamed, so a failed run never leaves a truncated CSV. flush checks that every file
+is on disk with the size that was written, and raises the first error if any failed.
+
+Frames must not be modified after they are submitted.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def _write(df: pd.DataFrame, output_filename: str, to_csv_kwargs: dict) -> int:
+    """Write df as CSV to output_filename. Returns the number of bytes written."""
+    data = df.to_csv(**to_csv_kwargs).encode()
+    temp_filename = output_filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(data)
+    os.replace(temp_filename, output_filename)
+    return len(data)
+
+
+class BackgroundWriter:
+    def __init__(self, num_threads: int = 4, max_pending: int = 16):
+        """
+        Args:
+            - num_threads: how many files are written at once.
+            - max_pending: how many frames can be queued or being written before submit
+                blocks.
+        """
+        self._executor = ThreadPoolExecutor(
+            num_threads, thread_name_prefix="csv_writer"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending: dict[str, Future] = {}
+
+    def submit(self, df: pd.DataFrame, output_filename: str, **to_csv_kwargs):
+        """Queue df.to_csv(output_filename, **to_csv_kwargs). Blocks while max_pending
+        frames are already queued."""
+        if output_filename in self._pending:
+            # the same file twice: the last one wins, as with direct writes
+            self._pending[output_filename].result()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(_write, df, output_filename, to_csv_kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending[output_filename] = future
+
+    def flush(self) -> list[str]:
+        """Wait for every queued write, and check each file has the size written.
+
+        Returns:
+            the files written since the last flush.
+        Raises:
+            the first error from a write or check, once all the writes are done.
+        """
+        errors = []
+        for output_filename, future in self._pending.items():
+            try:
+                size = future.result()
+                if os.path.getsize(output_filename) != size:
+                    raise OSError(
+                        f"{output_filename} has {os.path.getsize(output_filename)} "
+                        f"bytes on disk, {size} were written"
+                    )
+            except Exception as e:
+                logger.error(f"Could not write {output_filename}: {e}")
+                errors.append(e)
+        written = list(self._pending)
+        self._pending = {}
+        if errors:
+            raise errors[0]
+        logger.info(f"Wrote and checked {len(written)} files")
+        return written
+
+    def close(self) -> list[str]:
+        """flush, then stop the threads."""
+        try:
+            return self.flush()
+        finally:
+            self._executor.shutdown()
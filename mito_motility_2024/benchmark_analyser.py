@@ -0,0 +1,102 @@
+"""
+End-to-end benchmark of cellprofiler_output_analyser.py on synthetic plates.
+
+For each size in SIZES: write a synthetic plate with synthetic_cellprofiler_exports.py,
+run the full analyser flow on it (as `python cellprofiler_output_analyser.py` would), and
+report the time, rows and peak memory of each stage from stage_profiler.
+
+The flow runs twice: on a cold parse cache, which parses every CSV and writes the
+sidecars, then again on the warm cache, as when re-running on the same exports. Each
+size has its own parse cache, deleted with its inputs, so the benchmark never touches
+the cache of real runs.
+
+Each size runs in a fresh process, so that its peak RSS is its own. The per-stage JSON
+reports go to BENCHMARK_FOLDER/<size>/stage_profile_<cold|warm>.json, and a summary
+across sizes to BENCHMARK_FOLDER/benchmark_summary.csv.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+import pandas as pd
+
+# ----------- CHANGE HERE ---------------
+BENCHMARK_FOLDER = "benchmark_folder"
+SIZES = {
+    "small": dict(num_wells=4, num_xy=3, num_t=3, cells_per_field=10, extra_columns=5),
+    "medium": dict(
+        num_wells=24, num_xy=9, num_t=10, cells_per_field=30, extra_columns=20
+    ),
+    "screen": dict(
+        num_wells=384, num_xy=9, num_t=1, cells_per_field=50, extra_columns=50
+    ),
+}
+KEEP_GENERATED_FILES = False
+# ---------------------------------------
+
+
+def run_size(size: str, plate: dict, benchmark_folder: str) -> list[dict]:
+    """Generate and analyse one synthetic plate. Runs in its own process.
+
+    Returns:
+        the per-stage summary from stage_profiler, for the cold and the warm cache run.
+    """
+    # imported here so that nothing is loaded in the parent process
+    import cellprofiler_output_analyser as analyser
+    from stage_profiler import RECORDS, stage, summarise, write_report
+    from synthetic_cellprofiler_exports import write_synthetic_exports
+
+    logging.getLogger(analyser.__name__).setLevel(logging.WARNING)
+    size_folder = os.path.join(benchmark_folder, size)
+    input_folder = os.path.join(size_folder, "input_folder")
+    output_folder = os.path.join(size_folder, "output_folder")
+    analyser.PARSE_CACHE_FOLDER = os.path.join(size_folder, "parse_cache")
+
+    with stage("generate") as record:
+        row_counts = write_synthetic_exports(
+            os.path.join(input_folder, "batch_synthetic", "plate1"), **plate
+        )
+        record["rows"] = sum(row_counts.values())
+    summaries = []
+    for cache in ["cold", "warm"]:
+        with stage(f"total_{cache}_cache"):
+            analyser.process_input_folders(
+                input_folder,
+                ["batch_synthetic"],
+                output_folder,
+                t_varies=plate.get("num_t", 1) > 1,
+                do_plot=False,
+            )
+        write_report(os.path.join(size_folder, f"stage_profile_{cache}.json"))
+        summaries += [dict(total, cache=cache) for total in summarise()]
+        RECORDS.clear()
+    if not KEEP_GENERATED_FILES:
+        shutil.rmtree(input_folder)
+        shutil.rmtree(output_folder)
+        shutil.rmtree(analyser.PARSE_CACHE_FOLDER)
+    return summaries
+
+
+if __name__ == "__main__":
+    sizes = sys.argv[1:] or list(SIZES)
+    context = multiprocessing.get_context("spawn")
+    summaries = []
+    for size in sizes:
+        print(f"benchmarking {size}: {SIZES[size]}")
+        start = time.perf_counter()
+        with context.Pool(1) as pool:
+            summary = pool.apply(run_size, (size, SIZES[size], BENCHMARK_FOLDER))
+        print(f"{size} took {time.perf_counter() - start:.1f}s")
+        summaries.append(pd.DataFrame(summary).assign(size=size))
+
+    summary_df = pd.concat(summaries, ignore_index=True)
+    summary_df = summary_df[
+        ["size", "cache", "stage", "calls", "wall_s", "cpu_s", "rows", "peak_rss_mb"]
+    ]
+    output_path = os.path.join(BENCHMARK_FOLDER, "benchmark_summary.csv")
+    summary_df.to_csv(output_path, index=False)
+    print(summary_df.to_string(index=False, float_format="{:.3f}".format))
+    print(f"summary written to {output_path}")
@@ -0,0 +1,403 @@
+"""
+Load every CellProfiler export under INPUT_FOLDER into one DuckDB database file, for
+ad hoc questions without re-running cellprofiler_output_analyser.py, e.g.
+
+    python cellprofiler_database.py      # (re-)ingest INPUT_SUBFOLDERS
+    python cellprofiler_database.py "
+        SELECT batch, WellNumber, median(CoV) FROM cov WHERE T >= 10
+        AND batch IN ('batch14', 'batch15') GROUP BY ALL ORDER BY ALL"
+
+The folder layout is the one the analyser expects, INPUT_FOLDER/batch/plate/*.csv, and
+every row gets batch, plate, WellNumber, XY and T (NULL if the filenames have no _T).
+
+Tables, one row per:
+    - images:             image, from the Image group of All_measurements.csv
+    - nuclei, edge_spots: object, from the Nuclei / edge_spots groups of All_measurements.csv
+    - expand_nuclei:      object in Expand_Nuclei.csv
+    - perinuclear_region: object in Perinuclear_region.csv
+    - plate_columns:      column each plate exported to each table, which the views use
+                          to pick the first candidate column per plate, as the analyser
+                          does per folder
+
+Rows are inserted sorted by (batch, plate, WellNumber, XY, T), so DuckDB's per-block
+min/max indexes skip the blocks a filter on those columns excludes.
+
+Views, the tidy data behind the generate_*_files outputs of the analyser:
+    - edge_spot_fraction:   nuclei_count, edge_spot_count and their ratio per field of view
+    - mass_displacement:    the MASS_DISPLACEMENT_COLS of each cell
+    - cov:                  CoV and the bonus_cols of each cell
+    - <metric>_mean_over_time_normalised: the mean per (well, T), normalised to the
+      baseline of the analyser (BASELINE_FRAMES / BASELINE_WINDOW)
+
+The wide tables are pivots of these, e.g. edge_spot_fraction_static.csv is
+wide_table(connection, "edge_spot_fraction", "edge_spot_fraction", "XY", "WellNumber").
+"""
+import glob
+import logging
+import os
+import sys
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+import cellprofiler_output_analyser as analyser
+from cellprofiler_output_analyser import extract_filename_metadata
+from parse_cache import read_csv_cached
+
+logger = logging.getLogger(__name__)
+
+# ----------- CHANGE HERE ---------------
+INPUT_FOLDER = "input_folder"
+INPUT_SUBFOLDERS = ["batch14"]
+DATABASE_PATH = "cellprofiler.duckdb"
+# ---------------------------------------
+
+TABLES = ["images", "nuclei", "edge_spots", "expand_nuclei", "perinuclear_region"]
+KEY_COLUMNS = ["batch", "plate", "WellNumber", "XY", "T"]
+
+
+def with_metadata(
+    df: pd.DataFrame, filenames: pd.Series, batch: str, plate: str
+) -> pd.DataFrame:
+    """df with batch, plate, WellNumber, XY and T in front, parsed from filenames."""
+    t_varies = bool(filenames.str.contains(r"_T\d+").all())
+    metadata = extract_filename_metadata(filenames, t_varies)
+    key_columns = {
+        "batch": batch,
+        "plate": plate,
+        "WellNumber": np.asarray(metadata["WellNumber"], dtype=object),
+        "XY": metadata["XY"],
+        "T": metadata["T"] if t_varies else pd.array([None] * len(df), dtype="Int32"),
+    }
+    return pd.concat([pd.DataFrame(key_columns, index=df.index), df], axis=1)
+
+
+def read_folder(folder: str, batch: str, plate: str) -> dict[str, pd.DataFrame]:
+    """The five tables for one folder of exports."""
+    all_measurements = read_csv_cached(
+        os.path.join(folder, analyser.EDGE_SPOT_FILE),
+        header_rows=2,
+        cache_folder=analyser.PARSE_CACHE_FOLDER,
+        max_cache_mb=analyser.PARSE_CACHE_MAX_MB,
+    )
+    image_group = all_measurements["Image"].drop_duplicates("ImageNumber")
+    tables = {
+        "images": with_metadata(
+            image_group, image_group[analyser.EDGE_SPOT_FILENAME_COLUMN], batch, plate
+        )
+    }
+    # ImageNumber -> the filename of the image, to give every object its metadata
+    image_filenames = image_group.set_index("ImageNumber")[
+        analyser.EDGE_SPOT_FILENAME_COLUMN
+    ]
+    for group in ["Nuclei", "edge_spots"]:
+        objects = all_measurements[group]
+        objects = objects[objects["ImageNumber"].notna()].astype(
+            {"ImageNumber": "int64"}
+        )
+        tables[group.lower()] = with_metadata(
+            objects, objects["ImageNumber"].map(image_filenames), batch, plate
+        )
+    for table, filename in [
+        ("expand_nuclei", analyser.MASS_DISPLACEMENT_FILE),
+        ("perinuclear_region", analyser.COV_FILE),
+    ]:
+        objects = read_csv_cached(
+            os.path.join(folder, filename),
+            cache_folder=analyser.PARSE_CACHE_FOLDER,
+            max_cache_mb=analyser.PARSE_CACHE_MAX_MB,
+        )
+        tables[table] = with_metadata(
+            objects, objects[analyser.MIRO_FILENAME_COLUMN], batch, plate
+        )
+    return tables
+
+
+def insert_table(connection, table: str, df: pd.DataFrame):
+    """Append df to table, creating the table, or any columns it does not have yet."""
+    connection.register("folder_df", df)
+    try:
+        existing = {
+            row[0]
+            for row in connection.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = ?",
+                [table],
+            ).fetchall()
+        }
+        if not existing:
+            connection.execute(
+                f"CREATE TABLE {table} AS SELECT * FROM folder_df "
+                f"ORDER BY {', '.join(KEY_COLUMNS)}"
+            )
+            return
+        for column, column_type in connection.execute(
+            "SELECT column_name, column_type FROM (DESCRIBE folder_df)"
+        ).fetchall():
+            if column not in existing:
+                connection.execute(
+                    f'ALTER TABLE {table} ADD COLUMN "{column}" {column_type}'
+                )
+        connection.execute(
+            f"INSERT INTO {table} BY NAME SELECT * FROM folder_df "
+            f"ORDER BY {', '.join(KEY_COLUMNS)}"
+        )
+    finally:
+        connection.unregister("folder_df")
+
+
+def ingest_folder(connection, folder: str, batch: str, plate: str):
+    """Replace the rows of (batch, plate) in every table with the exports in folder."""
+    tables = read_folder(folder, batch, plate)
+    connection.execute("BEGIN TRANSACTION")
+    try:
+        for table, df in tables.items():
+            if table_exists(connection, table):
+                connection.execute(
+                    f"DELETE FROM {table} WHERE batch = ? AND plate = ?", [batch, plate]
+                )
+            insert_table(connection, table, df)
+        record_plate_columns(connection, tables, batch, plate)
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    logger.info(
+        f"Ingested {folder}: "
+        + ", ".join(f"{len(df)} {table}" for table, df in tables.items())
+    )
+
+
+def record_plate_columns(
+    connection, tables: dict[str, pd.DataFrame], batch: str, plate: str
+):
+    """Replace the plate_columns rows of (batch, plate) with the columns of its tables."""
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS plate_columns "
+        "(batch VARCHAR, plate VARCHAR, table_name VARCHAR, column_name VARCHAR)"
+    )
+    connection.execute(
+        "DELETE FROM plate_columns WHERE batch = ? AND plate = ?", [batch, plate]
+    )
+    connection.executemany(
+        "INSERT INTO plate_columns VALUES (?, ?, ?, ?)",
+        [
+            (batch, plate, table, str(column))
+            for table, df in tables.items()
+            for column in df.columns
+        ],
+    )
+
+
+def table_exists(connection, table: str) -> bool:
+    return bool(
+        connection.execute(
+            "SELECT count(*) FROM information_schema.tables WHERE table_name = ?",
+            [table],
+        ).fetchone()[0]
+    )
+
+
+def table_columns(connection, table: str) -> list[str]:
+    return [
+        row[0]
+        for row in connection.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ?",
+            [table],
+        ).fetchall()
+    ]
+
+
+def _quote(column: str) -> str:
+    return f'"{column}"'
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _first_present(
+    candidates: list[str], present: list[str]
+) -> list[tuple[list[str], str]]:
+    """The candidate columns the table has, as options for _select_first_exported."""
+    found = [column for column in candidates if column in present]
+    if not found:
+        raise ValueError(f"None of {candidates} were ingested")
+    return [([column], _quote(column)) for column in found]
+
+
+def _select_first_exported(
+    table: str, columns: list[str], metrics: dict[str, list[tuple[list[str], str]]]
+) -> str:
+    """SELECT columns of table, and each metric as the first of its options that the
+    row's plate exported, as the analyser picks the first column present in each folder.
+
+    Which option each plate uses is worked out from the small plate_columns table and
+    joined on, rather than from the ingested rows. Unlike COALESCE, a missing value in
+    the chosen column stays missing rather than being taken from the next candidate.
+
+    Args:
+        - table: the table the columns are in.
+        - columns: selected as they are.
+        - metrics: name -> (columns, expression) options, in order of preference.
+            Metrics with a single option are selected without the join.
+    """
+    selected = list(columns)
+    joins = []
+    for name, options in metrics.items():
+        if len(options) == 1:
+            selected.append(f"{options[0][1]} AS {_quote(name)}")
+            continue
+        choice = f"choice_{len(joins)}"
+        exported_sql = " ".join(
+            "WHEN "
+            + " AND ".join(
+                f"bool_or(table_name = {_literal(table)} "
+                f"AND column_name = {_literal(column)})"
+                for column in option_columns
+            )
+            + f" THEN {i}"
+            for i, (option_columns, _) in enumerate(options)
+        )
+        joins.append(
+            f"LEFT JOIN (SELECT batch, plate, CASE {exported_sql} END AS {choice} "
+            f"FROM plate_columns GROUP BY batch, plate) USING (batch, plate)"
+        )
+        expression_sql = " ".join(
+            f"WHEN {i} THEN {expression}" for i, (_, expression) in enumerate(options)
+        )
+        selected.append(f"CASE {choice} {expression_sql} END AS {_quote(name)}")
+    return f"SELECT {', '.join(selected)} FROM {table} {' '.join(joins)}"
+
+
+def normalised_mean_over_time_sql(view: str, value_column: str) -> str:
+    """The mean of value_column per (batch, plate, WellNumber, T), divided by its
+    baseline as in analyser.normalise_time_series."""
+    if analyser.BASELINE_WINDOW is not None:
+        first, last = analyser.BASELINE_WINDOW
+        in_baseline = f"T BETWEEN {first} AND {last}"
+    else:
+        in_baseline = f"frame <= {analyser.BASELINE_FRAMES}"
+    return f"""
+        WITH means AS (
+            SELECT batch, plate, WellNumber, T, avg({_quote(value_column)}) AS mean,
+                dense_rank() OVER (PARTITION BY batch, plate, WellNumber ORDER BY T)
+                    AS frame
+            FROM {view} WHERE T IS NOT NULL GROUP BY batch, plate, WellNumber, T
+        )
+        SELECT batch, plate, WellNumber, T, mean,
+            mean / avg(CASE WHEN {in_baseline} THEN mean END)
+                OVER (PARTITION BY batch, plate, WellNumber) AS normalised
+        FROM means
+    """
+
+
+def create_views(connection):
+    """(Re-)create the views over the ingested tables."""
+    connection.execute(
+        """
+        CREATE OR REPLACE VIEW edge_spot_fraction AS
+        WITH nuclei_counts AS (
+            SELECT batch, plate, ImageNumber, count(*) AS nuclei_count
+            FROM nuclei GROUP BY ALL
+        ), edge_spot_counts AS (
+            SELECT batch, plate, ImageNumber, count(*) AS edge_spot_count
+            FROM edge_spots GROUP BY ALL
+        )
+        SELECT batch, plate, WellNumber, XY, T,
+            sum(coalesce(nuclei_count, 0)) AS nuclei_count,
+            sum(coalesce(edge_spot_count, 0)) AS edge_spot_count,
+            sum(coalesce(edge_spot_count, 0)) / sum(coalesce(nuclei_count, 0))
+                AS edge_spot_fraction
+        FROM images
+        LEFT JOIN nuclei_counts USING (batch, plate, ImageNumber)
+        LEFT JOIN edge_spot_counts USING (batch, plate, ImageNumber)
+        GROUP BY batch, plate, WellNumber, XY, T
+        """
+    )
+    metrics = {"edge_spot_fraction": ["edge_spot_fraction"]}
+
+    object_columns = KEY_COLUMNS + ["ImageNumber", "ObjectNumber"]
+    expand_nuclei_columns = table_columns(connection, "expand_nuclei")
+    mass_displacement = {}
+    for name, candidates in analyser.MASS_DISPLACEMENT_COLS.items():
+        candidates = [candidates] if isinstance(candidates, str) else candidates
+        mass_displacement[name] = _first_present(candidates, expand_nuclei_columns)
+    connection.execute(
+        "CREATE OR REPLACE VIEW mass_displacement AS "
+        + _select_first_exported("expand_nuclei", object_columns, mass_displacement)
+    )
+    metrics["mass_displacement"] = list(analyser.MASS_DISPLACEMENT_COLS)
+
+    perinuclear_columns = table_columns(connection, "perinuclear_region")
+    cov = [
+        ([std, mean], f"{_quote(std)} / {_quote(mean)}")
+        for std, mean in zip(analyser.COV_STD_COLUMNS, analyser.COV_MEAN_COLUMNS)
+        if std in perinuclear_columns and mean in perinuclear_columns
+    ]
+    if not cov:
+        raise ValueError('Could not find a column for "CoV"')
+    bonus_cols = [col for col in analyser.bonus_cols if col in perinuclear_columns]
+    connection.execute(
+        "CREATE OR REPLACE VIEW cov AS "
+        + _select_first_exported(
+            "perinuclear_region",
+            object_columns + [_quote(col) for col in bonus_cols],
+            {"CoV": cov},
+        )
+    )
+    metrics["cov"] = ["CoV"] + bonus_cols
+
+    for view, value_columns in metrics.items():
+        for value_column in value_columns:
+            connection.execute(
+                f"CREATE OR REPLACE VIEW {_quote(value_column + '_mean_over_time_normalised')}"
+                f" AS {normalised_mean_over_time_sql(view, value_column)}"
+            )
+
+
+def ingest(
+    input_folder: str,
+    input_subfolders: list[str],
+    database_path: str = DATABASE_PATH,
+):
+    """Ingest INPUT_FOLDER/subfolder/plate for every plate of every subfolder, replacing
+    what was ingested for them before, then refresh the views."""
+    with duckdb.connect(database_path) as connection:
+        for input_subfolder in input_subfolders:
+            for folder in sorted(
+                glob.glob(os.path.join(input_folder, input_subfolder, "*/"))
+            ):
+                plate = os.path.basename(os.path.normpath(folder))
+                ingest_folder(connection, folder, input_subfolder, plate)
+        create_views(connection)
+
+
+def wide_table(
+    connection,
+    view: str,
+    value_column: str,
+    index: str,
+    columns: str,
+    where: str = "TRUE",
+) -> pd.DataFrame:
+    """A pivot of a view, e.g. the values per XY (index) and WellNumber (columns) as in
+    the static tables of the analyser. Use `where` to pick a batch, plate or well."""
+    return (
+        connection.sql(
+            f"PIVOT (SELECT * FROM {_quote(view)} WHERE {where}) "
+            f"ON {_quote(columns)} USING first({_quote(value_column)}) "
+            f"GROUP BY {_quote(index)} ORDER BY {_quote(index)}"
+        )
+        .df()
+        .set_index(index)
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with duckdb.connect(DATABASE_PATH, read_only=True) as connection:
+            print(connection.sql(" ".join(sys.argv[1:])))
+    else:
+        ingest(INPUT_FOLDER, INPUT_SUBFOLDERS)
+        logger.info(f"Database written to {DATABASE_PATH}")
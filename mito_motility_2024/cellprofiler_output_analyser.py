@@ -34,6 +34,10 @@ Then average over XYs and plot:
 T1  |  mean_fraction | mean_fraction | mean_fraction
 ...
 
+  If the edge spots have their parent nuclei, also count the edge spots of each nucleus
+  (edge_spots_per_nucleus.csv), and add the mean spots per nucleus and the fraction of nuclei with
+  at least k spots to the intermediate.
+
 - from Expand_nuclei, extract the mass displacement of the 60mer/mito for each cell. As this is a per-cell measure,
   we don't really care about XY, but track anyway. Generate intermediate with Well, XY, T, and
   mass displacement, where there are N rows per (well, XY, T) combination, where N is the number
@@ -79,12 +83,18 @@ Then average over values and generate:
 - from Perinuclear_region, extract the CoV for each cell, and then generate files as for the mass
   displacement.
 
+- join Expand_nuclei, Perinuclear_region and the Nuclei of All_measurements into one row per cell, on
+  (ImageNumber, parent nucleus), with Well, XY, T, the mass displacement, CoV and bonus columns, and
+  every measurement of each table prefixed by the table, e.g. Perinuclear_region_AreaShape_Area.
+  Written as PER_CELL_FILE (parquet) if set, e.g. for correlating measures per cell.
+
 
 Script parameters:
     - input_folder: path to the folder containing the input files
     - output_folder: path to the folder where the output files will be written
     - t_varies: boolean, whether the T parameter varies or not
-    - plot: boolean, whether to plot the output.
+    - plot: boolean, whether to plot the output. Plots are queued during processing and rendered
+      at the end, in parallel and without a display, as PLOT_FORMAT files next to their CSVs.
 
 
 """
@@ -92,12 +102,20 @@ import glob
 import logging
 import os
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 
-sns.set_style("whitegrid")
+from background_writer import BackgroundWriter
+from parse_cache import columns_cached, read_csv_cached
+import table_utils
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from stage_profiler import profiled, report, stage  # noqa: E402
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
@@ -121,12 +139,58 @@ MASS_DISPLACEMENT_COLS = {
 }
 LOGGING_LEVEL = logging.INFO  # logging.INFO or logging.ERROR  normally
 PLOT = False
+PLOT_FORMAT = "png"  # or "svg"
+PLOT_WORKERS = 4
+# CSVs are written by WRITER_THREADS background threads, while the next ones are computed.
+# At most WRITER_MAX_PENDING tables wait to be written. 0 threads to write them inline.
+WRITER_THREADS = 4
+WRITER_MAX_PENDING = 16
 T_VARIES = False
+# Time series are normalised to a baseline: the mean of the first BASELINE_FRAMES timepoints,
+# or, if set, of the timepoints in BASELINE_WINDOW, e.g. (1, 5) for the frames before treatment.
+BASELINE_FRAMES = 1
+BASELINE_WINDOW = None
+# If set, the normalised tables are indexed by minutes rather than T
+FRAME_INTERVAL_MINUTES = None
+# Timings and peak memory of each stage are written here, and summarised at the end
+PROFILE_REPORT = os.path.join(OUTPUT_FOLDER, "stage_profile.json")
+# Parsed CSVs are cached here as parquet, so that re-runs only load the columns they use.
+# Least recently used files are deleted beyond PARSE_CACHE_MAX_MB. None to disable.
+PARSE_CACHE_FOLDER = "parse_cache"
+PARSE_CACHE_MAX_MB = 2048
+# One row per cell with the metadata and every measurement of the cell, joined across
+# Expand_Nuclei, Perinuclear_region and the Nuclei of All_measurements, e.g.
+# "per_cell.parquet". None to skip.
+PER_CELL_FILE = None
+# For the fraction of nuclei with at least k edge spots, per field of view
+EDGE_SPOT_THRESHOLDS = [1, 2, 5]
 
 bonus_cols = ["Intensity_MassDisplacement_MIRO160mer", "GINI_Gini_MIRO160mer"]
 
 # ---------------------------------------
 
+# Plots queued by queue_plot, for render_plots
+PLOT_SPECS: list[dict] = []
+# The BackgroundWriter of the current run of process_input_folders, if any
+WRITER: BackgroundWriter | None = None
+
+# The source columns of the extract_* functions, the only ones loaded from the parse cache
+EDGE_SPOT_FILENAME_COLUMN = "FileName_Hoechst"  # for the well number, xy and t
+NUCLEI_COUNT_COLUMN = "Number_Object_Number"
+EDGE_SPOT_COUNT_COLUMN = "Number_Object_Number"
+EDGE_SPOT_PARENT_COLUMN = "Parent_Nuclei"  # 0 for spots outside any nucleus
+# MIRO_FILENAME_COLUMN = "FileName_mito"
+# MIRO_FILENAME_COLUMN = "FileName_pex"
+MIRO_FILENAME_COLUMN = "FileName_MIRO160mer"
+COV_STD_COLUMNS = [
+    "Intensity_StdIntensity_MIRO160mer",
+    "Intensity_StdIntensity_MIRO160mer_rescaled",
+]
+COV_MEAN_COLUMNS = [
+    "Intensity_MeanIntensity_MIRO160mer",
+    "Intensity_MeanIntensity_MIRO160mer_rescaled",
+]
+
 
 def generate_edge_spot_files(
     input_path: str, output_folder: str, t_varies: bool, do_plot=True
@@ -149,12 +213,29 @@ def generate_edge_spot_files(
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    raw_input_df = pd.read_csv(input_path, header=[0, 1])
+    raw_input_df = read_cellprofiler_csv(
+        input_path,
+        columns=[
+            ("Image", EDGE_SPOT_FILENAME_COLUMN),
+            ("Nuclei", "ImageNumber"),
+            ("Nuclei", NUCLEI_COUNT_COLUMN),
+            ("edge_spots", "ImageNumber"),
+            ("edge_spots", EDGE_SPOT_COUNT_COLUMN),
+            ("edge_spots", EDGE_SPOT_PARENT_COLUMN),
+        ],
+        header_rows=2,
+    )
 
-    processed_df = extract_edgespot_cols(raw_input_df, t_varies)
+    processed_df, per_nucleus_df = extract_edgespot_cols(raw_input_df, t_varies)
     intermediate_filepath = os.path.join(output_folder, "edge_spot_fraction_raw.csv")
     logger.info(f"Writing edge spot intermediate to {intermediate_filepath}")
-    processed_df.to_csv(intermediate_filepath, index=False)
+    write_csv(processed_df, intermediate_filepath, index=False)
+    if per_nucleus_df is not None:
+        write_csv(
+            per_nucleus_df,
+            os.path.join(output_folder, "edge_spots_per_nucleus.csv"),
+            index=False,
+        )
 
     if t_varies:
         # File for each well number, T as columns, XY as rows
@@ -172,28 +253,20 @@ def generate_edge_spot_files(
             )
 
         # average over XYs, normalise and plot:
-        average_over_time = (
-            processed_df.groupby(["WellNumber", "T"])
-            .edge_spot_fraction.mean()
-            .reset_index()
-        )
-        pivot = pd.pivot_table(
-            data=average_over_time,
-            values="edge_spot_fraction",
-            index="T",
-            columns="WellNumber",
-        )
-        pivot = pivot.divide(pivot.iloc[0])
+        pivot = normalised_mean_over_time(processed_df, "edge_spot_fraction")
         output_path = os.path.join(
             output_folder, "edge_spot_fraction_mean_over_time_normalised.csv"
         )
         logger.info(
             f"Normalised pivot table has shape {pivot.shape}, writing to {output_path}"
         )
-        pivot.to_csv(output_path)
+        write_csv(pivot, output_path)
         if do_plot:
-            pivot.plot(title="Edge spot fraction over time, normalised to T0")
-            plt.show()
+            queue_plot(
+                pivot,
+                "Edge spot fraction over time, normalised to baseline",
+                output_path,
+            )
 
     else:
         # single file - well number vs xy.
@@ -207,53 +280,130 @@ def generate_edge_spot_files(
         )
 
 
+@profiled("extract", rows=lambda result: len(result[0]))
 def extract_edgespot_cols(
     cellprofiler_df: pd.DataFrame, t_varies: bool
-) -> pd.DataFrame:
+) -> tuple[pd.DataFrame, pd.DataFrame | None]:
     """
-    Extract the (well_number, xy, t) columns and aggregate over W, XY, T
-    to generate the edge spot data.
+    Extract the (well_number, xy, t) columns and count the nuclei and edge spots of each
+    field of view, to generate the edge spot data.
     Makes a number of assumptions about the struture of the input df.
+
+    If the edge spots have their parent nucleus (EDGE_SPOT_PARENT_COLUMN), also count the
+    spots of each nucleus, and add the mean spots per nucleus and the fraction of nuclei
+    with at least k spots (k in EDGE_SPOT_THRESHOLDS) to each field of view.
+
+    Returns:
+        one row per field of view, and one row per nucleus (None without the parents).
     """
     logger.info(f"Extracting columns, input df has shape {cellprofiler_df.shape}")
-    filename_column = "FileName_Hoechst"  # from which we extract the well number and xy
-    nuclei_count_column = "Number_Object_Number"
-    edge_spot_count_column = "Number_Object_Number"
-
-    output_df = cellprofiler_df.copy()
-    if t_varies:
-        output_df["T"] = output_df["Image"][filename_column].apply(extract_timestamp)
-    output_df["XY"] = output_df["Image"][filename_column].apply(extract_xy)
-    output_df["WellNumber"] = output_df["Image"][filename_column].apply(
-        extract_wellnumber
+    metadata = extract_filename_metadata(
+        cellprofiler_df["Image"][EDGE_SPOT_FILENAME_COLUMN], t_varies
     )
-    output_df["nuclei_count"] = output_df["Nuclei"][nuclei_count_column]
-    output_df["edge_spot_count"] = output_df["edge_spots"][edge_spot_count_column]
-    cols = ["WellNumber", "XY", "nuclei_count", "edge_spot_count"]
-    if t_varies:
-        cols.append("T")
-    output_df = output_df[cols].reset_index(drop=True)
-    output_df.columns = output_df.columns.droplevel(
-        1
-    )  # drop the second level of the multiindex
-
-    aggregate_df = (
-        output_df.groupby(
-            ["WellNumber", "XY", "T"] if t_varies else ["WellNumber", "XY"]
-        )
-        .agg({"nuclei_count": "count", "edge_spot_count": "count"})
-        .reset_index()
+    field_codes, aggregate_df = field_of_view_codes(metadata)
+    num_fields = len(aggregate_df)
+    nuclei = cellprofiler_df["Nuclei"]
+    edge_spots = cellprofiler_df["edge_spots"]
+    has_nucleus = nuclei[NUCLEI_COUNT_COLUMN].notna().to_numpy()
+    has_edge_spot = edge_spots[EDGE_SPOT_COUNT_COLUMN].notna().to_numpy()
+    nucleus_fields = field_codes[has_nucleus]
+
+    nuclei_count = np.bincount(nucleus_fields, minlength=num_fields)
+    aggregate_df["nuclei_count"] = nuclei_count
+    aggregate_df["edge_spot_count"] = np.bincount(
+        field_codes[has_edge_spot], minlength=num_fields
     )
     aggregate_df["edge_spot_fraction"] = (
         aggregate_df["edge_spot_count"] / aggregate_df["nuclei_count"]
     )
 
+    per_nucleus_df = None
+    if EDGE_SPOT_PARENT_COLUMN in edge_spots.columns:
+        spots_per_nucleus = count_spots_per_nucleus(
+            nuclei[has_nucleus], edge_spots[has_edge_spot]
+        )
+        aggregate_df["mean_spots_per_nucleus"] = (
+            np.bincount(nucleus_fields, spots_per_nucleus, minlength=num_fields)
+            / nuclei_count
+        )
+        for threshold in EDGE_SPOT_THRESHOLDS:
+            aggregate_df[f"fraction_with_{threshold}_or_more_spots"] = (
+                np.bincount(
+                    nucleus_fields, spots_per_nucleus >= threshold, minlength=num_fields
+                )
+                / nuclei_count
+            )
+        per_nucleus_df = pd.DataFrame(
+            {
+                **{key: values[has_nucleus] for key, values in metadata.items()},
+                "ImageNumber": nuclei["ImageNumber"][has_nucleus].to_numpy(np.int64),
+                "ObjectNumber": nuclei[NUCLEI_COUNT_COLUMN][has_nucleus].to_numpy(
+                    np.int64
+                ),
+                "edge_spot_count": spots_per_nucleus,
+            }
+        )
+
     logger.info(
         f"Extracted columns and aggregated, output df has shape {aggregate_df.shape}"
     )
-    return aggregate_df
+    return aggregate_df, per_nucleus_df
+
 
+def field_of_view_codes(metadata: dict) -> tuple[np.ndarray, pd.DataFrame]:
+    """Number the fields of view (WellNumber, XY[, T]) in sorted order.
+
+    Returns:
+        the field of view of each row, and a table of the fields of view.
+    """
+    wells = metadata["WellNumber"]
+    keys = (wells.codes.astype(np.int64) << 40) | (
+        metadata["XY"].astype(np.int64) << 20
+    )
+    if "T" in metadata:
+        keys |= metadata["T"].astype(np.int64)
+    field_keys, field_codes = np.unique(keys, return_inverse=True)
+    fields = {
+        "WellNumber": pd.Categorical.from_codes(
+            field_keys >> 40, categories=wells.categories
+        ),
+        "XY": ((field_keys >> 20) & 0xFFFFF).astype(np.int32),
+    }
+    if "T" in metadata:
+        fields["T"] = (field_keys & 0xFFFFF).astype(np.int32)
+    return field_codes, pd.DataFrame(fields)
+
+
+def count_spots_per_nucleus(
+    nuclei_df: pd.DataFrame, edge_spots_df: pd.DataFrame
+) -> np.ndarray:
+    """The number of edge spots whose parent is each nucleus, in the order of nuclei_df.
+
+    Each spot is matched to its nucleus by (ImageNumber, parent), as a position in the
+    sorted nucleus keys, and the positions are counted in one bincount. Spots outside
+    any nucleus (parent 0) are not counted.
 
+    Args:
+        - nuclei_df: one row per nucleus, with ImageNumber and NUCLEI_COUNT_COLUMN (its
+            object number).
+        - edge_spots_df: one row per edge spot, with ImageNumber and
+            EDGE_SPOT_PARENT_COLUMN.
+    """
+    nucleus_keys = object_keys(nuclei_df["ImageNumber"], nuclei_df[NUCLEI_COUNT_COLUMN])
+    if len(nucleus_keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+    edge_spots_df = edge_spots_df[edge_spots_df[EDGE_SPOT_PARENT_COLUMN] > 0]
+    spot_keys = object_keys(
+        edge_spots_df["ImageNumber"], edge_spots_df[EDGE_SPOT_PARENT_COLUMN]
+    )
+    order = np.argsort(nucleus_keys, kind="stable")
+    sorted_keys = nucleus_keys[order]
+    positions = np.searchsorted(sorted_keys, spot_keys).clip(max=len(sorted_keys) - 1)
+    matched = sorted_keys[positions] == spot_keys
+    return np.bincount(order[positions[matched]], minlength=len(nucleus_keys))
+
+
+@profiled("extract", rows=len)
 def extract_massdisplacement_cols(cellprofiler_df, t_varies: bool) -> pd.DataFrame:
     """Extract well number, xy, t, mass, displacement columns from the cellprofiler df.
     As above, makes strong assumptions about input shape and labels.
@@ -261,69 +411,73 @@ def extract_massdisplacement_cols(cellprofiler_df, t_varies: bool) -> pd.DataFra
     Christina is a criminal and thus the miro and mito displacments may or may not be there.
     """
     logger.info(f"Extracting columns, input df has shape {cellprofiler_df.shape}")
-    # filename_column = "FileName_mito"
-    # filename_column = "FileName_pex"
-    filename_column = "FileName_MIRO160mer"
-    output_df = cellprofiler_df.copy()
-    if t_varies:
-        output_df["T"] = output_df[filename_column].apply(extract_timestamp)
-    output_df["XY"] = output_df[filename_column].apply(extract_xy)
-    output_df["WellNumber"] = output_df[filename_column].apply(extract_wellnumber)
-    cols = []
+    metadata = extract_filename_metadata(
+        cellprofiler_df[MIRO_FILENAME_COLUMN], t_varies
+    )
+    columns = {"WellNumber": metadata["WellNumber"], "XY": metadata["XY"]}
     if "mass_displacement_mito" in MASS_DISPLACEMENT_COLS:
         col = MASS_DISPLACEMENT_COLS["mass_displacement_mito"]
-        output_df["mass_displacement_mito"] = output_df[col]
-        cols.append("mass_displacement_mito")
+        columns["mass_displacement_mito"] = cellprofiler_df[col].to_numpy()
     if "mass_displacement_60mer" in MASS_DISPLACEMENT_COLS:
         for col in MASS_DISPLACEMENT_COLS["mass_displacement_60mer"]:
-            try:
-                output_df["mass_displacement_60mer"] = output_df[col]
+            if col in cellprofiler_df:
+                columns["mass_displacement_60mer"] = cellprofiler_df[col].to_numpy()
                 break
-            except KeyError:
-                continue
         else:
             raise ValueError('Could not find a column for "mass_displacement_60mer"')
-        cols.append("mass_displacement_60mer")
-    cols = ["WellNumber", "XY"] + cols
     if t_varies:
-        cols.append("T")
-    output_df = output_df[cols].reset_index(drop=True)
-    return output_df
+        columns["T"] = metadata["T"]
+    return pd.DataFrame(columns)
 
 
+@profiled("extract", rows=len)
 def extract_cov_cols(
     cellprofiler_df, t_varies: bool, bonus_cols: list[str] = []
 ) -> pd.DataFrame:
     """Extract well number, xy, t, and CoV."""
     logger.info(f"Extracting columns, input df has shape {cellprofiler_df.shape}")
-    filename_column = "FileName_MIRO160mer"
-    std_columns = [
-        "Intensity_StdIntensity_MIRO160mer",
-        "Intensity_StdIntensity_MIRO160mer_rescaled",
-    ]
-    mean_columns = [
-        "Intensity_MeanIntensity_MIRO160mer",
-        "Intensity_MeanIntensity_MIRO160mer_rescaled",
-    ]
-    output_df = cellprofiler_df.copy()
-    if t_varies:
-        output_df["T"] = output_df[filename_column].apply(extract_timestamp)
-    output_df["XY"] = output_df[filename_column].apply(extract_xy)
-    output_df["WellNumber"] = output_df[filename_column].apply(extract_wellnumber)
-    for std_col, mean_col in zip(std_columns, mean_columns):
-        try:
-            output_df["CoV"] = output_df[std_col] / output_df[mean_col]
+    metadata = extract_filename_metadata(
+        cellprofiler_df[MIRO_FILENAME_COLUMN], t_varies
+    )
+    columns = {"WellNumber": metadata["WellNumber"], "XY": metadata["XY"]}
+    for std_col, mean_col in zip(COV_STD_COLUMNS, COV_MEAN_COLUMNS):
+        if std_col in cellprofiler_df and mean_col in cellprofiler_df:
+            columns["CoV"] = (
+                cellprofiler_df[std_col] / cellprofiler_df[mean_col]
+            ).to_numpy()
             break
-        except KeyError:
-            continue
     else:
         raise ValueError('Could not find a column for "CoV"')
-    cols = ["WellNumber", "XY", "CoV"]
     if t_varies:
-        cols.append("T")
-    cols += bonus_cols
-    output_df = output_df[cols].reset_index(drop=True)
-    return output_df
+        columns["T"] = metadata["T"]
+    for col in bonus_cols:
+        columns[col] = cellprofiler_df[col].to_numpy()
+    return pd.DataFrame(columns)
+
+
+def extract_filename_metadata(filenames: pd.Series, t_varies: bool) -> dict:
+    """WellNumber, XY and (if t_varies) T for each row, from its image filename.
+
+    All the objects in an image share its filename, so the regexes run once per unique
+    filename and the results are spread back to the rows by code. WellNumber comes back
+    categorical (its categories sorted, so groupbys order wells as before) and XY/T as
+    int32.
+    """
+    codes, unique_filenames = pd.factorize(filenames)
+    metadata = {
+        "WellNumber": pd.Categorical(
+            [extract_wellnumber(filename) for filename in unique_filenames]
+        ).take(codes),
+        "XY": np.array(
+            [extract_xy(filename) for filename in unique_filenames], dtype=np.int32
+        )[codes],
+    }
+    if t_varies:
+        metadata["T"] = np.array(
+            [extract_timestamp(filename) for filename in unique_filenames],
+            dtype=np.int32,
+        )[codes]
+    return metadata
 
 
 def extract_xy(input_string: str) -> int:
@@ -341,10 +495,49 @@ def extract_wellnumber(input_string: str) -> str:
     return re.search(r"(?<=Well)[A-Z]\d+", input_string).group(0)
 
 
+def read_cellprofiler_csv(
+    input_path: str, columns: list | None, header_rows: int = 1
+) -> pd.DataFrame:
+    """Read the given columns of a CellProfiler CSV through the parse cache, timed as a
+    "read" stage. Columns missing from the file are left out, None reads them all."""
+    with stage("read", file=input_path) as record:
+        df = read_csv_cached(
+            input_path,
+            header_rows,
+            columns,
+            cache_folder=PARSE_CACHE_FOLDER,
+            max_cache_mb=PARSE_CACHE_MAX_MB,
+        )
+        record["rows"] = len(df)
+    return df
+
+
 def save_pivot_table(data, values, index, columns, output_filename: str):
-    pivot = pd.pivot_table(data=data, values=values, index=index, columns=columns)
+    with stage("pivot", rows=len(data)):
+        pivot = pd.pivot_table(
+            data=data, values=values, index=index, columns=columns, observed=True
+        )
     logger.info(f"writing pivot table: {output_filename}")
-    pivot.to_csv(output_filename)
+    write_csv(pivot, output_filename)
+
+
+def close_writer():
+    """Wait for the writes queued on WRITER, and stop it. Raises the first failed write."""
+    global WRITER
+    if WRITER is not None:
+        writer, WRITER = WRITER, None
+        with stage("flush"):
+            writer.close()
+
+
+def write_csv(df: pd.DataFrame, output_filename: str, **kwargs):
+    """df.to_csv, queued on WRITER if there is one, timed as a "write" stage. With the
+    writer, the stage is how long the processing waited for a free slot."""
+    with stage("write", rows=len(df), file=output_filename):
+        if WRITER is not None:
+            WRITER.submit(df, output_filename, **kwargs)
+        else:
+            df.to_csv(output_filename, **kwargs)
 
 
 def generate_mass_displacement_files(
@@ -366,7 +559,10 @@ def generate_mass_displacement_files(
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    raw_input_df = pd.read_csv(mass_displacement_file_path)
+    source_columns = [MIRO_FILENAME_COLUMN]
+    for cols in MASS_DISPLACEMENT_COLS.values():
+        source_columns += [cols] if isinstance(cols, str) else cols
+    raw_input_df = read_cellprofiler_csv(mass_displacement_file_path, source_columns)
     processed_df = extract_massdisplacement_cols(raw_input_df, t_varies)
     for displacement_type in MASS_DISPLACEMENT_COLS:
         generate_ragged_df(
@@ -389,7 +585,9 @@ def generate_cov_files(cov_file_path, output_folder, t_varies, do_plot=True):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    raw_input_df = pd.read_csv(cov_file_path)
+    raw_input_df = read_cellprofiler_csv(
+        cov_file_path, [MIRO_FILENAME_COLUMN] + COV_STD_COLUMNS + COV_MEAN_COLUMNS
+    )
     processed_df = extract_cov_cols(raw_input_df, t_varies)
     generate_ragged_df(
         processed_df,
@@ -406,12 +604,13 @@ def generate_extra_dispersion_measures(
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    raw_input_df = pd.read_csv(cov_file_path)
+    raw_input_df = read_cellprofiler_csv(
+        cov_file_path,
+        [MIRO_FILENAME_COLUMN] + COV_STD_COLUMNS + COV_MEAN_COLUMNS + bonus_cols,
+    )
     processed_df = extract_cov_cols(raw_input_df, t_varies, bonus_cols=bonus_cols)
 
-  
-    derived_cols = [  #  insert extra cols here 
-    ]
+    derived_cols = []  #  insert extra cols here
 
     for bonus_col in bonus_cols + derived_cols:
         generate_ragged_df(
@@ -423,6 +622,197 @@ def generate_extra_dispersion_measures(
         )
 
 
+def object_keys(image_numbers: pd.Series, object_numbers: pd.Series) -> np.ndarray:
+    """(ImageNumber, object number) packed into one int64 per object, to join on."""
+    return (np.asarray(image_numbers, dtype=np.int64) << 32) | np.asarray(
+        object_numbers, dtype=np.int64
+    )
+
+
+def parent_nucleus_keys(objects_df: pd.DataFrame) -> np.ndarray:
+    """The key of the nucleus each object belongs to: its Parent_Nuclei if exported,
+    otherwise its own ObjectNumber (objects expanded from the nuclei share their
+    numbers)."""
+    parent_column = (
+        "Parent_Nuclei" if "Parent_Nuclei" in objects_df.columns else "ObjectNumber"
+    )
+    return object_keys(objects_df["ImageNumber"], objects_df[parent_column])
+
+
+def _prefixed(objects_df: pd.DataFrame, prefix: str, keys: np.ndarray) -> pd.DataFrame:
+    return objects_df.set_axis(
+        [f"{prefix}_{column}" for column in objects_df.columns], axis=1
+    ).set_index(pd.Index(keys, name="key"))
+
+
+@profiled("join", rows=len)
+def build_per_cell_table(
+    nuclei_df: pd.DataFrame,
+    expand_nuclei_df: pd.DataFrame,
+    perinuclear_df: pd.DataFrame,
+    t_varies: bool,
+    bonus_cols: list[str] = [],
+) -> pd.DataFrame:
+    """One row per cell of Expand_Nuclei, with the matching rows of Perinuclear_region and
+    of the Nuclei group of All_measurements joined on (ImageNumber, parent nucleus).
+
+    Each table is keyed by a single packed int64 and sorted, so the joins are merges of
+    sorted unique keys. Cells missing from a table get NaNs for its columns.
+
+    Args:
+        - nuclei_df: the Nuclei group of All_measurements, i.e. all_measurements["Nuclei"].
+        - expand_nuclei_df / perinuclear_df: the per-object tables.
+    Returns:
+        Well, XY, (T), ImageNumber and ObjectNumber (of the nucleus), the mass displacement,
+        CoV and bonus columns as extracted for the other outputs, then every column of
+        each table, prefixed with its name.
+    """
+    expand_keys = parent_nucleus_keys(expand_nuclei_df)
+    metrics = extract_massdisplacement_cols(expand_nuclei_df, t_varies)
+    metadata_columns = ["WellNumber", "XY"] + (["T"] if t_varies else [])
+    per_cell = metrics[metadata_columns].assign(
+        ImageNumber=expand_nuclei_df["ImageNumber"].to_numpy(),
+        ObjectNumber=expand_keys & 0xFFFFFFFF,
+        **{column: metrics[column] for column in MASS_DISPLACEMENT_COLS},
+    )
+    per_cell.index = pd.Index(expand_keys, name="key")
+
+    perinuclear_keys = parent_nucleus_keys(perinuclear_df)
+    cov_df = extract_cov_cols(perinuclear_df, t_varies, bonus_cols=bonus_cols)
+    cov_df = cov_df.drop(columns=["WellNumber", "XY", "T"], errors="ignore")
+    cov_df.index = pd.Index(perinuclear_keys, name="key")
+
+    nuclei_df = nuclei_df[nuclei_df["ImageNumber"].notna()]
+    nuclei_keys = object_keys(
+        nuclei_df["ImageNumber"], nuclei_df["Number_Object_Number"]
+    )
+
+    tables = [
+        cov_df,
+        _prefixed(expand_nuclei_df, "Expand_Nuclei", expand_keys),
+        _prefixed(perinuclear_df, "Perinuclear_region", perinuclear_keys),
+        _prefixed(nuclei_df, "Nuclei", nuclei_keys),
+    ]
+    per_cell = per_cell.sort_index()
+    for table in tables:
+        per_cell = per_cell.join(table.sort_index(), how="left", validate="one_to_one")
+    return per_cell.reset_index(drop=True)
+
+
+def generate_per_cell_table(
+    edge_spot_file_path: str,
+    mass_displacement_file_path: str,
+    cov_file_path: str,
+    output_folder: str,
+    t_varies: bool,
+):
+    """Build the per-cell table (see build_per_cell_table) and write it to
+    output_folder/PER_CELL_FILE. Raises a pd.errors.MergeError if a nucleus is the
+    parent of several objects in Expand_Nuclei or Perinuclear_region."""
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    # only the Nuclei group of the (wide) All_measurements
+    nuclei_columns = [
+        column
+        for column in columns_cached(
+            edge_spot_file_path,
+            header_rows=2,
+            cache_folder=PARSE_CACHE_FOLDER,
+            max_cache_mb=PARSE_CACHE_MAX_MB,
+        )
+        if column[0] == "Nuclei"
+    ]
+    nuclei_df = read_cellprofiler_csv(
+        edge_spot_file_path, columns=nuclei_columns, header_rows=2
+    )["Nuclei"]
+    expand_nuclei_df = read_cellprofiler_csv(mass_displacement_file_path, columns=None)
+    perinuclear_df = read_cellprofiler_csv(cov_file_path, columns=None)
+    per_cell = build_per_cell_table(
+        nuclei_df, expand_nuclei_df, perinuclear_df, t_varies, bonus_cols=bonus_cols
+    )
+    output_path = os.path.join(output_folder, PER_CELL_FILE)
+    logger.info(f"writing per-cell table with shape {per_cell.shape}: {output_path}")
+    with stage("write", rows=len(per_cell), file=output_path):
+        per_cell.to_parquet(output_path, index=False)
+
+
+def normalise_time_series(
+    tidy_df: pd.DataFrame,
+    value_column: str,
+    group_columns: Optional[list[str]] = None,
+    time_column="T",
+    baseline_frames: Optional[int] = None,
+    baseline_window: Optional[tuple[int, int]] = None,
+    frame_interval: Optional[float] = None,
+) -> pd.DataFrame:
+    """Divide each time series by its baseline, in one grouped pass over the tidy data.
+
+    The settings left as None are read from the CHANGE HERE constants when called, so
+    changing those (e.g. from a notebook) applies to later calls.
+
+    Args:
+        - tidy_df: one row per (group_columns, time_column), e.g. the mean per (WellNumber, T).
+        - value_column: the column to normalise.
+        - group_columns: the columns identifying each series. ["WellNumber"] if None.
+        - baseline_frames: the baseline is the mean of the first N timepoints of each series.
+            BASELINE_FRAMES if None.
+        - baseline_window: (first T, last T), inclusive. Used instead of baseline_frames if set.
+            BASELINE_WINDOW if None, unless baseline_frames is given.
+        - frame_interval: minutes between timepoints. If set, adds a "minutes" column, with
+            the first timepoint (T=1) at 0. FRAME_INTERVAL_MINUTES if None.
+    Returns:
+        tidy_df with the normalised values in f"{value_column}_normalised".
+    """
+    if group_columns is None:
+        group_columns = ["WellNumber"]
+    if baseline_window is None and baseline_frames is None:
+        baseline_window = BASELINE_WINDOW
+    if baseline_frames is None:
+        baseline_frames = BASELINE_FRAMES
+    if frame_interval is None:
+        frame_interval = FRAME_INTERVAL_MINUTES
+
+    if baseline_window is not None:
+        in_baseline = tidy_df[time_column].between(*baseline_window)
+    else:
+        frame_number = tidy_df.groupby(group_columns)[time_column].rank(method="dense")
+        in_baseline = frame_number <= baseline_frames
+    baseline = (
+        tidy_df[value_column]
+        .where(in_baseline)
+        .groupby([tidy_df[column] for column in group_columns])
+        .transform("mean")
+    )
+    normalised_df = tidy_df.assign(
+        **{f"{value_column}_normalised": tidy_df[value_column] / baseline}
+    )
+    if frame_interval is not None:
+        normalised_df["minutes"] = (normalised_df[time_column] - 1) * frame_interval
+    return normalised_df
+
+
+@profiled("aggregate", rows=len)
+def normalised_mean_over_time(
+    input_df: pd.DataFrame, value_column: str
+) -> pd.DataFrame:
+    """The mean of value_column per (WellNumber, T), normalised to the baseline of each
+    well, with a column per well and a row per timepoint."""
+    mean_over_time = (
+        input_df.groupby(["WellNumber", "T"], observed=True)[value_column]
+        .mean()
+        .reset_index()
+    )
+    normalised_df = normalise_time_series(mean_over_time, value_column)
+    time_axis = "minutes" if "minutes" in normalised_df else "T"
+    return normalised_df.set_index([time_axis, "WellNumber"])[
+        f"{value_column}_normalised"
+    ].unstack("WellNumber")
+
+
+# all the ragged tables are timed as one "pivot" stage
+ragged_columns = profiled("pivot", rows=len)(table_utils.ragged_columns)
+
+
 def generate_ragged_df(
     input_df, data_column, output_folder, t_varies: bool, do_plot=True
 ):
@@ -430,32 +820,21 @@ def generate_ragged_df(
     if t_varies:
         # A file per wellnumber, with T and XY as columns and subcolumns
         subdf = input_df[["WellNumber", "XY", "T", data_column]]
-        for well_number in subdf.WellNumber.unique():
-            well_number_subdf = subdf[subdf.WellNumber == well_number]
-            # highly mysterious pandas esoterica to generate columns for T and XY
+        for well_number, well_number_subdf in subdf.groupby(
+            "WellNumber", sort=False, observed=True
+        ):
             output_filename = os.path.join(
                 output_folder, f"{data_column}_time_and_xy_{well_number}.csv"
             )
-            output_df = (
-                well_number_subdf.drop(columns=["WellNumber"])
-                .set_index(["T", "XY"])
-                .squeeze()
-            )
-            output_df = output_df.reset_index(name="value")
-            output_df["index"] = output_df.groupby(["T", "XY"]).cumcount()
-            output_df = output_df.set_index(["T", "XY", "index"])["value"].unstack(
-                level=[0, 1]
-            )
+            output_df = ragged_columns(well_number_subdf, data_column, ["T", "XY"])
             logger.info(
                 f"writing {data_column} table with shape {output_df.shape}: {output_filename}"
             )
-            output_df.to_csv(output_filename)
+            write_csv(output_df, output_filename)
 
-            # pivot to generate a column for each T
-            stacked_df = well_number_subdf.drop(columns=["WellNumber", "XY"])
-            stacked_df["count"] = stacked_df.groupby("T").cumcount()
-            stacked_df = stacked_df.pivot(
-                index="count", columns="T", values=data_column
+            # a column for each T
+            stacked_df = ragged_columns(
+                well_number_subdf, data_column, ["T"], index_name="count"
             )
             output_filename = os.path.join(
                 output_folder, f"{data_column}_stacked_{well_number}.csv"
@@ -463,57 +842,48 @@ def generate_ragged_df(
             logger.info(
                 f"writing stacked {data_column} table with shape {stacked_df.shape}: {output_filename}"
             )
-            stacked_df.to_csv(output_filename)
+            write_csv(stacked_df, output_filename)
 
         # Average over Well, T, save and plot
-        average_over_time = (
-            subdf.groupby(["WellNumber", "T"])[data_column].mean().reset_index()
-        )
-        pivot = pd.pivot_table(
-            data=average_over_time,
-            values=data_column,
-            index="T",
-            columns="WellNumber",
-        )
-        pivot = pivot.divide(pivot.iloc[0])
+        pivot = normalised_mean_over_time(subdf, data_column)
         output_path = os.path.join(
             output_folder, f"{data_column}_mean_over_time_normalised.csv"
         )
         logger.info(
             f"Normalised pivot table has shape {pivot.shape}, writing to {output_path}"
         )
-        pivot.to_csv(output_path)
+        write_csv(pivot, output_path)
         if do_plot:
-            pivot.plot(title=f"Mean {data_column} over time, normalised to T0")
-            plt.show()
+            queue_plot(
+                pivot,
+                f"Mean {data_column} over time, normalised to baseline",
+                output_path,
+            )
 
     else:
         # Generate a table with WellNumber and XY as columns, and the data column as the vals
         output_filename = os.path.join(output_folder, f"{data_column}_static.csv")
-        subdf = input_df[["WellNumber", "XY", data_column]].copy()
-        subdf["index"] = subdf.groupby(["WellNumber", "XY"]).cumcount()
-        subdf = subdf.pivot(
-            index="index", columns=["WellNumber", "XY"], values=data_column
-        )
+        subdf = ragged_columns(input_df, data_column, ["WellNumber", "XY"])
         logger.info(
             f"writing static {data_column} table with shape {subdf.shape}: {output_filename}"
         )
-        subdf.to_csv(output_filename)
+        write_csv(subdf, output_filename)
 
         # Generate a table with Wellnumber as columns, XY as rows, and the median of the data column as the vals.
         median_df = (
-            input_df.groupby(["WellNumber", "XY"])[[data_column]].median().unstack().T
+            input_df.groupby(["WellNumber", "XY"], observed=True)[[data_column]]
+            .median()
+            .unstack()
+            .T
         )
         median_filename = os.path.join(
             output_folder, f"{data_column}_fov_median_static.csv"
         )
-        median_df.to_csv(median_filename)
+        write_csv(median_df, median_filename)
 
-        # Pivot to generate a column for each WellNumber
-        stacked_df = input_df[["WellNumber", data_column]].copy()
-        stacked_df["count"] = stacked_df.groupby("WellNumber").cumcount()
-        stacked_df = stacked_df.pivot(
-            index="count", columns="WellNumber", values=data_column
+        # A column for each WellNumber
+        stacked_df = ragged_columns(
+            input_df, data_column, ["WellNumber"], index_name="count"
         )
         output_filename = os.path.join(
             output_folder, f"{data_column}_stacked_static.csv"
@@ -521,34 +891,116 @@ def generate_ragged_df(
         logger.info(
             f"writing stacked {data_column} table with shape {stacked_df.shape}: {output_filename}"
         )
-        stacked_df.to_csv(output_filename)
+        write_csv(stacked_df, output_filename)
+
+
+def queue_plot(data: pd.DataFrame, title: str, csv_path: str):
+    """Record a line plot of data (a line per column), to be rendered by render_plots
+    once all the processing is done. It goes next to its CSV, as PLOT_FORMAT."""
+    output_path = f"{os.path.splitext(csv_path)[0]}.{PLOT_FORMAT}"
+    PLOT_SPECS.append({"data": data, "title": title, "output_path": output_path})
+
 
+def render_plot(spec: dict) -> str:
+    """Render one queued plot with the non-interactive Agg backend. Runs in a worker
+    process: matplotlib and seaborn are only imported there."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
+    sns.set_style("whitegrid")
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    spec["data"].plot(ax=ax, title=spec["title"])
+    fig.savefig(spec["output_path"], bbox_inches="tight")
+    return spec["output_path"]
+
+
+def render_plots(specs: list[dict], num_workers: int = PLOT_WORKERS) -> list[str]:
+    """Render the queued plots in a process pool, then empty the queue.
+
+    Returns:
+        the paths written.
+    """
+    with stage("plot", rows=len(specs)):
+        with ProcessPoolExecutor(num_workers) as executor:
+            output_paths = list(executor.map(render_plot, specs))
+    logger.info(f"Rendered {len(output_paths)} plots")
+    specs.clear()
+    return output_paths
+
+
+def process_input_folders(
+    input_folder: str,
+    input_subfolders: list[str],
+    output_folder: str,
+    t_varies: bool,
+    do_plot=True,
+):
+    """Generate all the output files for every folder in each of the input_subfolders,
+    then render the plots queued along the way if do_plot.
+
+    The CSVs are written in the background (see WRITER_THREADS), and all of them are
+    waited for and checked before this returns.
+
+    Output for INPUT_FOLDER/subfolder/folder goes to OUTPUT_FOLDER/subfolder/folder.
+    """
+    global WRITER
+    if WRITER_THREADS:
+        WRITER = BackgroundWriter(WRITER_THREADS, WRITER_MAX_PENDING)
+    try:
+        for input_subfolder in input_subfolders:
+            folders = glob.glob(os.path.join(input_folder, input_subfolder, "*/"))
+            for folder in folders:
+                logger.info(f"Processing {folder}")
+                output_subfolder = folder.replace(input_folder, output_folder)
+                edge_spot_file_path = os.path.join(folder, EDGE_SPOT_FILE)
+                generate_edge_spot_files(
+                    edge_spot_file_path, output_subfolder, t_varies, do_plot
+                )
+                logger.info("\n")
+                mass_displacement_file_path = os.path.join(
+                    folder, MASS_DISPLACEMENT_FILE
+                )
+                generate_mass_displacement_files(
+                    mass_displacement_file_path, output_subfolder, t_varies, do_plot
+                )
+                logger.info("\n")
+                cov_file_path = os.path.join(folder, COV_FILE)
+                generate_cov_files(cov_file_path, output_subfolder, t_varies, do_plot)
+                generate_extra_dispersion_measures(
+                    cov_file_path,
+                    output_subfolder,
+                    t_varies,
+                    bonus_cols=bonus_cols,
+                    do_plot=do_plot,
+                )
+                if PER_CELL_FILE is not None:
+                    try:
+                        generate_per_cell_table(
+                            edge_spot_file_path,
+                            mass_displacement_file_path,
+                            cov_file_path,
+                            output_subfolder,
+                            t_varies,
+                        )
+                    except (KeyError, ValueError) as e:
+                        # e.g. a pd.errors.MergeError from duplicated parent nuclei
+                        logger.error(f"Skipping the per-cell table of {folder}: {e}")
+    except BaseException:
+        # keep the error that stopped the run: writes failing too are only logged
+        try:
+            close_writer()
+        except Exception as e:
+            logger.error(f"Could not finish the pending writes: {e}")
+        raise
+    close_writer()
+    if do_plot and PLOT_SPECS:
+        render_plots(PLOT_SPECS, PLOT_WORKERS)
 
 
 if __name__ == "__main__":
-    for INPUT_SUBFOLDER in INPUT_SUBFOLDERS:
-        input_folders = glob.glob(os.path.join(INPUT_FOLDER, INPUT_SUBFOLDER, "*/"))
-        for input_folder in input_folders:
-            logger.info(f"Processing {input_folder}")
-            output_subfolder = input_folder.replace(INPUT_FOLDER, OUTPUT_FOLDER)
-            edge_spot_file_path = os.path.join(input_folder, EDGE_SPOT_FILE)
-            generate_edge_spot_files(
-                edge_spot_file_path, output_subfolder, T_VARIES, PLOT
-            )
-            logger.info("\n")
-            mass_displacement_file_path = os.path.join(
-                input_folder, MASS_DISPLACEMENT_FILE
-            )
-            generate_mass_displacement_files(
-                mass_displacement_file_path, output_subfolder, T_VARIES, PLOT
-            )
-            logger.info("\n")
-            cov_file_path = os.path.join(input_folder, COV_FILE)
-            generate_cov_files(cov_file_path, output_subfolder, T_VARIES, PLOT)
-            generate_extra_dispersion_measures(
-                cov_file_path,
-                output_subfolder,
-                T_VARIES,
-                bonus_cols=bonus_cols,
-                do_plot=PLOT,
-            )
+    process_input_folders(INPUT_FOLDER, INPUT_SUBFOLDERS, OUTPUT_FOLDER, T_VARIES, PLOT)
+    report(PROFILE_REPORT)
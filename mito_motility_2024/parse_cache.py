@@ -0,0 +1,174 @@
+"""
+A parse cache for the raw CellProfiler CSVs, so that re-running
+cellprofiler_output_analyser.py on the same exports (e.g. while changing
+MASS_DISPLACEMENT_COLS or bonus_cols) does not parse every CSV again.
+
+The first read of a CSV parses it as usual and writes a zstd-compressed parquet sidecar
+to the cache folder. A two-row header (Image / Nuclei / edge_spots groups) is flattened
+to "group::column" in the sidecar and restored on read. Later reads load only the
+requested columns from the sidecar.
+
+Sidecars are keyed by the absolute path, size and modification time of the CSV, so a
+re-exported file is parsed again. The cache is bounded in total size: every hit marks
+the sidecar as recently used, and the least recently used sidecars are deleted once the
+total goes over the limit.
+"""
+
+import hashlib
+import logging
+import os
+from typing import Optional, Sequence
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+CACHE_FOLDER = "parse_cache"
+MAX_CACHE_MB = 2048
+HEADER_SEPARATOR = "::"
+
+
+def sidecar_path(csv_path: str, header_rows: int, cache_folder: str) -> str:
+    """The sidecar of the current version of csv_path."""
+    stat = os.stat(csv_path)
+    key = f"{os.path.abspath(csv_path)}|{stat.st_size}|{stat.st_mtime_ns}|{header_rows}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_folder, f"{name}_{digest}.parquet")
+
+
+def _flatten_column(column) -> str:
+    return HEADER_SEPARATOR.join(column) if isinstance(column, tuple) else column
+
+
+def _restore_names(names: Sequence[str], header_rows: int) -> list:
+    if header_rows > 1:
+        return [tuple(name.split(HEADER_SEPARATOR)) for name in names]
+    return list(names)
+
+
+def _restore_columns(df: pd.DataFrame, header_rows: int) -> pd.DataFrame:
+    if header_rows > 1:
+        df.columns = pd.MultiIndex.from_tuples(_restore_names(df.columns, header_rows))
+    return df
+
+
+def write_sidecar(df: pd.DataFrame, path: str):
+    """Write df, header flattened, to a parquet sidecar. Written to a temporary file
+    first, so that an interrupted write never leaves a truncated sidecar."""
+    table = pa.Table.from_pandas(
+        df.set_axis([_flatten_column(column) for column in df.columns], axis=1),
+        preserve_index=False,
+    )
+    temp_path = path + ".tmp"
+    pq.write_table(table, temp_path, compression="zstd")
+    os.replace(temp_path, path)
+
+
+def evict(cache_folder: str, max_cache_mb: float):
+    """Delete the least recently used sidecars until the cache fits in max_cache_mb."""
+    sidecars = [
+        entry
+        for entry in os.scandir(cache_folder)
+        if entry.is_file() and entry.name.endswith(".parquet")
+    ]
+    sidecars.sort(key=lambda entry: entry.stat().st_mtime)
+    total_bytes = sum(entry.stat().st_size for entry in sidecars)
+    for entry in sidecars:
+        if total_bytes <= max_cache_mb * 1024**2:
+            break
+        logger.info(f"Evicting {entry.name} from the parse cache")
+        total_bytes -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def read_csv_cached(
+    csv_path: str,
+    header_rows: int = 1,
+    columns: Optional[Sequence] = None,
+    cache_folder: Optional[str] = CACHE_FOLDER,
+    max_cache_mb: float = MAX_CACHE_MB,
+) -> pd.DataFrame:
+    """pd.read_csv, through the parse cache.
+
+    Args:
+        - csv_path: the CellProfiler CSV.
+        - header_rows: 2 for All_measurements.csv, whose columns are (group, column).
+        - columns: the columns to load, as (group, column) tuples if header_rows is 2.
+            Columns missing from the file are skipped, as the extractors have their own
+            fallbacks. None for all columns.
+        - cache_folder: where the sidecars are kept. None to always parse the CSV.
+        - max_cache_mb: the limit on the total size of the sidecars.
+    Returns:
+        the parsed CSV, as pd.read_csv(csv_path, header=list(range(header_rows))) would,
+        restricted to `columns`.
+    """
+    if cache_folder is None:
+        return _select(_read_csv(csv_path, header_rows), columns)
+    path = sidecar_path(csv_path, header_rows, cache_folder)
+    if os.path.exists(path):
+        logger.info(f"Reading {csv_path} from the parse cache: {path}")
+        os.utime(path)  # marks it as recently used
+        if columns is None:
+            df = pq.read_table(path).to_pandas()
+        else:
+            stored = set(pq.read_schema(path).names)
+            wanted = [_flatten_column(column) for column in columns]
+            df = pq.read_table(
+                path, columns=[column for column in wanted if column in stored]
+            ).to_pandas()
+        return _restore_columns(df, header_rows)
+
+    df = _read_csv(csv_path, header_rows)
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+    try:
+        write_sidecar(df, path)
+    except (pa.ArrowException, ValueError) as e:
+        # e.g. a column of mixed strings and numbers. Not worth failing the run for.
+        logger.warning(f"Could not cache {csv_path}, it will be parsed every time: {e}")
+    else:
+        evict(cache_folder, max_cache_mb)
+    return _select(df, columns)
+
+
+def columns_cached(
+    csv_path: str,
+    header_rows: int = 1,
+    cache_folder: Optional[str] = CACHE_FOLDER,
+    max_cache_mb: float = MAX_CACHE_MB,
+) -> list:
+    """The columns of csv_path, from the schema of its sidecar, so that choosing which
+    columns to load does not open the CSV once the cache is warm. A CSV without a
+    sidecar is parsed and cached first, as read_csv_cached would.
+
+    Returns:
+        the column names, as (group, column) tuples if header_rows is 2.
+    """
+    if cache_folder is not None:
+        path = sidecar_path(csv_path, header_rows, cache_folder)
+        if not os.path.exists(path):
+            read_csv_cached(csv_path, header_rows, [], cache_folder, max_cache_mb)
+        if os.path.exists(path):
+            os.utime(path)  # marks it as recently used
+            return _restore_names(pq.read_schema(path).names, header_rows)
+    # no cache, or the CSV could not be cached
+    return list(
+        pd.read_csv(
+            csv_path, header=list(range(header_rows)) if header_rows > 1 else 0, nrows=0
+        ).columns
+    )
+
+
+def _read_csv(csv_path: str, header_rows: int) -> pd.DataFrame:
+    return pd.read_csv(
+        csv_path, header=list(range(header_rows)) if header_rows > 1 else 0
+    )
+
+
+def _select(df: pd.DataFrame, columns: Optional[Sequence]) -> pd.DataFrame:
+    if columns is None:
+        return df
+    return df[[column for column in columns if column in df.columns]]
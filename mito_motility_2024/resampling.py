@@ -0,0 +1,292 @@
+"""
+Hierarchical bootstrap and permutation statistics for comparing two conditions, e.g.
+TRAK1_79 vs TRAK2_78 in the per_track table from trackmate_analyser.py, or two wells in
+the per-cell tables from cellprofiler_output_analyser.py.
+
+The data is hierarchical (observations within cells, cells within dates), so resampling
+treats the cell as the unit and respects the clusters it belongs to:
+
+- bootstrap: within each condition, resample clusters with replacement, then units
+  within each chosen cluster with replacement.
+- permutation: shuffle the condition labels between units within each cluster.
+
+Each unit is reduced to the sum and count of its values. The statistic is the pooled
+mean of a condition (sum of sums / sum of counts), which for a boolean column is the
+proportion, e.g. of tracks ending above zero. Replicates are then weighted sums over
+units, drawn as (replicates, units) matrices a block at a time. Blocks run in parallel,
+and are optionally saved as .npz so that an interrupted run carries on where it stopped.
+"""
+
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+NUM_WORKERS = 8
+BLOCK_SIZE = 1000
+
+
+def summarise_units(
+    df: pd.DataFrame,
+    value_column: str,
+    condition_column: str = "condition",
+    cluster_column: Optional[str] = "date",
+    unit_columns: Optional[Sequence[str]] = ("cell",),
+) -> pd.DataFrame:
+    """Reduce the observations to one row per unit with the sum and count of its values.
+
+    Args:
+        - df: one row per observation, e.g. per track.
+        - value_column: the values to compare. Booleans are treated as 0/1.
+        - condition_column: the conditions being compared.
+        - cluster_column: the level above the unit, e.g. the date. None for no clusters.
+        - unit_columns: what identifies a unit within its cluster, e.g. the cell.
+            None to use every row as its own unit.
+    Returns:
+        a table with condition, cluster, sum and count columns, NaN values dropped.
+    """
+    df = df[df[value_column].notna()]
+    keys = [condition_column] + ([cluster_column] if cluster_column else [])
+    keys += list(unit_columns) if unit_columns is not None else []
+    values = df[value_column].astype(float)
+    if unit_columns is None:
+        units = df[keys].assign(sum=values, count=1)
+    else:
+        units = (
+            values.groupby([df[key] for key in keys], sort=False)
+            .agg(["sum", "count"])
+            .reset_index()
+        )
+    return pd.DataFrame(
+        {
+            "condition": units[condition_column].to_numpy(),
+            "cluster": units[cluster_column].to_numpy() if cluster_column else 0,
+            "sum": units["sum"].to_numpy(),
+            "count": units["count"].to_numpy(),
+        }
+    )
+
+
+def _pooled_means(weights: np.ndarray, sums: np.ndarray, counts: np.ndarray):
+    """Mean of the observations for each row of a (replicates, units) weight matrix."""
+    return (weights @ sums) / (weights @ counts)
+
+
+def bootstrap_block(
+    units: Dict[str, np.ndarray], n_replicates: int, seed: int, block: int
+) -> np.ndarray:
+    """Two-level bootstrap of the pooled mean of each condition.
+
+    For each replicate, clusters are drawn with replacement, and then as many units as the
+    cluster has are drawn with replacement from each drawn cluster. A cluster drawn k times
+    contributes k * n draws from its own n units, so the unit weights are a multinomial per
+    cluster, drawn for all replicates at once.
+
+    Returns:
+        (n_replicates, 2) bootstrapped means of condition 0 and condition 1.
+    """
+    rng = np.random.default_rng([seed, block])
+    means = np.empty((n_replicates, 2))
+    for condition in (0, 1):
+        in_condition = units["condition"] == condition
+        clusters = units["cluster"][in_condition]
+        sums, counts = units["sum"][in_condition], units["count"][in_condition]
+        cluster_ids = np.unique(clusters)
+        cluster_draws = rng.multinomial(
+            len(cluster_ids),
+            np.full(len(cluster_ids), 1 / len(cluster_ids)),
+            n_replicates,
+        )
+        weights = np.zeros((n_replicates, len(sums)))
+        for i, cluster_id in enumerate(cluster_ids):
+            in_cluster = np.flatnonzero(clusters == cluster_id)
+            n = len(in_cluster)
+            weights[:, in_cluster] = rng.multinomial(
+                cluster_draws[:, i] * n, np.full(n, 1 / n)
+            )
+        means[:, condition] = _pooled_means(weights, sums, counts)
+    return means
+
+
+def permutation_block(
+    units: Dict[str, np.ndarray], n_replicates: int, seed: int, block: int
+) -> np.ndarray:
+    """Difference in pooled means (condition 1 - condition 0) with the condition labels
+    shuffled between the units of each cluster.
+
+    Returns:
+        (n_replicates,) permuted differences.
+    """
+    rng = np.random.default_rng([seed, block])
+    totals = np.zeros((4, n_replicates))  # sum/count of condition 0, then condition 1
+    for cluster_id in np.unique(units["cluster"]):
+        in_cluster = np.flatnonzero(units["cluster"] == cluster_id)
+        # a row of random keys per replicate, argsorted, is a block of permutations
+        permutations = rng.random((n_replicates, len(in_cluster))).argsort(axis=1)
+        permuted_conditions = units["condition"][in_cluster][permutations]
+        for condition in (0, 1):
+            weights = permuted_conditions == condition
+            totals[2 * condition] += weights @ units["sum"][in_cluster]
+            totals[2 * condition + 1] += weights @ units["count"][in_cluster]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return totals[2] / totals[3] - totals[0] / totals[1]
+
+
+def _fingerprint(units: Dict[str, np.ndarray], *params) -> str:
+    """Identify the resampled data and the parameters of a run."""
+    sha = hashlib.sha256()
+    for name in sorted(units):
+        sha.update(np.ascontiguousarray(units[name]).tobytes())
+    sha.update(repr(params).encode())
+    return sha.hexdigest()[:16]
+
+
+def run_blocks(
+    block_function: Callable[[Dict[str, np.ndarray], int, int, int], np.ndarray],
+    units: Dict[str, np.ndarray],
+    n_replicates: int,
+    seed: int = 0,
+    block_size: int = BLOCK_SIZE,
+    checkpoint_folder: Optional[str] = None,
+    num_workers: int = NUM_WORKERS,
+) -> np.ndarray:
+    """Run n_replicates of block_function, block_size at a time, in parallel.
+
+    Every block has its own seed, so the result does not depend on the number of workers,
+    or on whether the run was resumed. With a checkpoint_folder, each finished block is
+    saved there, and blocks already saved by an earlier run with the same data and
+    parameters are loaded instead of recomputed.
+    """
+    n_blocks = -(-n_replicates // block_size)
+    sizes = [
+        min(block_size, n_replicates - block * block_size) for block in range(n_blocks)
+    ]
+    block_paths = [None] * n_blocks
+    if checkpoint_folder is not None:
+        run_id = _fingerprint(
+            units, block_function.__name__, n_replicates, seed, block_size
+        )
+        os.makedirs(checkpoint_folder, exist_ok=True)
+        block_paths = [
+            os.path.join(checkpoint_folder, f"{run_id}_{block:05d}.npz")
+            for block in range(n_blocks)
+        ]
+
+    results: List[Optional[np.ndarray]] = [None] * n_blocks
+    for block, block_path in enumerate(block_paths):
+        if block_path is not None and os.path.exists(block_path):
+            results[block] = np.load(block_path)["replicates"]
+    todo = [block for block in range(n_blocks) if results[block] is None]
+    if len(todo) < n_blocks:
+        logger.info(f"Resuming: {n_blocks - len(todo)}/{n_blocks} blocks already done")
+
+    with ProcessPoolExecutor(min(num_workers, max(len(todo), 1))) as executor:
+        futures = {
+            block: executor.submit(block_function, units, sizes[block], seed, block)
+            for block in todo
+        }
+        for block, future in futures.items():
+            results[block] = future.result()
+            if block_paths[block] is not None:
+                # write then rename, so that a killed run never leaves a partial block
+                temp_path = block_paths[block] + ".tmp.npz"
+                np.savez(temp_path, replicates=results[block])
+                os.replace(temp_path, block_paths[block])
+    return np.concatenate(results)
+
+
+def compare_conditions(
+    df: pd.DataFrame,
+    value_column: str,
+    condition_a: str,
+    condition_b: str,
+    condition_column: str = "condition",
+    cluster_column: Optional[str] = "date",
+    unit_columns: Optional[Sequence[str]] = ("cell",),
+    n_bootstrap: int = 10000,
+    n_permutations: int = 10000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    checkpoint_folder: Optional[str] = None,
+    num_workers: int = NUM_WORKERS,
+) -> pd.Series:
+    """Compare the mean of value_column between two conditions.
+
+    See summarise_units for the hierarchy arguments. For the per_track table from
+    trackmate_analyser, the defaults resample cells within dates.
+
+    For the per-cell tables from cellprofiler_output_analyser, cells in the same field of
+    view are not independent, so the field (WellNumber + XY) is the unit, and its cells
+    are summarised within it. Comparing two wells: condition_column="WellNumber",
+    cluster_column=None, unit_columns=("XY",). Comparing conditions that span several
+    wells: unit_columns=("WellNumber", "XY"), with the plate or date as the cluster if
+    each has both conditions, else None. Do not use the cells themselves as units
+    (unit_columns=None): that treats them as independent replicates.
+
+    Raises:
+        ValueError if either condition has no values, and so no units to resample.
+    Returns:
+        - mean_a, mean_b and difference (mean_b - mean_a)
+        - percentile bootstrap confidence intervals for each
+        - the two-sided permutation p-value of the difference
+    """
+    units_df = summarise_units(
+        df, value_column, condition_column, cluster_column, unit_columns
+    )
+    units_df = units_df[units_df["condition"].isin([condition_a, condition_b])]
+    for condition in (condition_a, condition_b):
+        if not (units_df["condition"] == condition).any():
+            raise ValueError(
+                f"No {value_column} values for {condition_column} == {condition!r}"
+            )
+    units = {
+        "condition": (units_df["condition"] == condition_b).to_numpy().astype(int),
+        "cluster": pd.factorize(units_df["cluster"])[0],
+        "sum": units_df["sum"].to_numpy(float),
+        "count": units_df["count"].to_numpy(float),
+    }
+    mean_a, mean_b = [
+        units["sum"][units["condition"] == condition].sum()
+        / units["count"][units["condition"] == condition].sum()
+        for condition in (0, 1)
+    ]
+    difference = mean_b - mean_a
+
+    run = dict(seed=seed, checkpoint_folder=checkpoint_folder, num_workers=num_workers)
+    bootstrapped = run_blocks(bootstrap_block, units, n_bootstrap, **run)
+    permuted = run_blocks(permutation_block, units, n_permutations, **run)
+
+    tail = (1 - confidence) / 2 * 100
+    mean_a_low, mean_a_high = np.percentile(bootstrapped[:, 0], [tail, 100 - tail])
+    mean_b_low, mean_b_high = np.percentile(bootstrapped[:, 1], [tail, 100 - tail])
+    difference_low, difference_high = np.percentile(
+        bootstrapped[:, 1] - bootstrapped[:, 0], [tail, 100 - tail]
+    )
+    # +1 counts the observed labelling as one of the permutations
+    extreme = np.sum(np.abs(permuted) >= np.abs(difference) - 1e-12)
+    p_value = (extreme + 1) / (len(permuted) + 1)
+    return pd.Series(
+        {
+            "value": value_column,
+            "condition_a": condition_a,
+            "condition_b": condition_b,
+            "n_units_a": int(np.sum(units["condition"] == 0)),
+            "n_units_b": int(np.sum(units["condition"] == 1)),
+            "mean_a": mean_a,
+            "mean_a_ci_low": mean_a_low,
+            "mean_a_ci_high": mean_a_high,
+            "mean_b": mean_b,
+            "mean_b_ci_low": mean_b_low,
+            "mean_b_ci_high": mean_b_high,
+            "difference": difference,
+            "difference_ci_low": difference_low,
+            "difference_ci_high": difference_high,
+            "p_value": p_value,
+        }
+    )
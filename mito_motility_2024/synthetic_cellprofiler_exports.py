@@ -0,0 +1,221 @@
+"""
+Write synthetic CellProfiler exports with the layout cellprofiler_output_analyser.py
+expects, for benchmarking without real (large, confidential) plates:
+
+OUTPUT_FOLDER
+    - subfolder
+      - All_measurements.csv   two header rows: Image / Nuclei / edge_spots groups
+      - Expand_Nuclei.csv      one row per nucleus
+      - Perinuclear_region.csv one row per nucleus
+
+Image filenames follow the usual conventions, e.g.
+Plate000_WellB02_Seq0001-MaxIP_XY3_T05_MIRO160mer.tif (no _T if there is a single
+timepoint), so that extract_wellnumber / extract_xy / extract_timestamp work on them.
+
+Every table is built with numpy in one go rather than row by row.
+"""
+import os
+import string
+
+import numpy as np
+import pandas as pd
+
+# ----------- CHANGE HERE ---------------
+OUTPUT_FOLDER = "synthetic_input_folder/batch_synthetic/plate1"
+NUM_WELLS = 24
+NUM_XY = 4
+NUM_T = 10
+CELLS_PER_FIELD = 20
+EDGE_SPOTS_PER_FIELD = 10
+EXTRA_COLUMNS = 20  # padding measurement columns per object, as in real exports
+# ---------------------------------------
+
+
+def well_names(num_wells: int) -> list[str]:
+    """A01, A02, ... filling the plate row by row, as on a 384 well plate (24 columns)."""
+    return [
+        f"{string.ascii_uppercase[i // 24]}{i % 24 + 1:02d}" for i in range(num_wells)
+    ]
+
+
+def image_table(num_wells: int, num_xy: int, num_t: int) -> pd.DataFrame:
+    """One row per image: ImageNumber, WellNumber, XY, T and the stem of its filename."""
+    wells, xys, ts = np.meshgrid(
+        np.array(well_names(num_wells)),
+        np.arange(1, num_xy + 1),
+        np.arange(1, num_t + 1),
+        indexing="ij",
+    )
+    images = pd.DataFrame(
+        {"WellNumber": wells.ravel(), "XY": xys.ravel(), "T": ts.ravel()}
+    )
+    images.insert(0, "ImageNumber", np.arange(1, len(images) + 1))
+    stem = (
+        "Plate000_Well"
+        + images["WellNumber"]
+        + "_Seq0001-MaxIP_XY"
+        + images["XY"].astype(str)
+    )
+    if num_t > 1:
+        stem += "_T" + images["T"].map("{:02d}".format)
+    images["stem"] = stem
+    return images
+
+
+def _object_numbers(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """For objects counted per image: the index of the image of each object, and its
+    ObjectNumber within the image (starting at 1)."""
+    image_index = np.repeat(np.arange(len(counts)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return image_index, np.arange(counts.sum()) - starts + 1
+
+
+def _extra_columns(rng, prefix: str, num_rows: int, num_columns: int) -> dict:
+    return {
+        f"{prefix}_{i:03d}": rng.random(num_rows).round(6) for i in range(num_columns)
+    }
+
+
+def all_measurements_table(
+    images: pd.DataFrame,
+    nuclei_counts: np.ndarray,
+    edge_spot_counts: np.ndarray,
+    extra_columns: int,
+    rng,
+) -> pd.DataFrame:
+    """All_measurements: the Image, Nuclei and edge_spots groups side by side, one row
+    per object, with as many rows per image as its larger group."""
+    rows_per_image = np.maximum(np.maximum(nuclei_counts, edge_spot_counts), 1)
+    image_index, row_number = _object_numbers(rows_per_image)
+    num_rows = len(image_index)
+    has_nucleus = row_number <= nuclei_counts[image_index]
+    has_edge_spot = row_number <= edge_spot_counts[image_index]
+    image_numbers = images["ImageNumber"].to_numpy()[image_index]
+
+    groups = {
+        "Image": {
+            "ImageNumber": image_numbers,
+            "FileName_Hoechst": (images["stem"] + "_Hoechst.tif").to_numpy()[
+                image_index
+            ],
+            **_extra_columns(rng, "Intensity_Image", num_rows, extra_columns),
+        },
+        "Nuclei": {
+            "ImageNumber": np.where(has_nucleus, image_numbers, np.nan),
+            "Number_Object_Number": np.where(has_nucleus, row_number, np.nan),
+            **{
+                name: np.where(has_nucleus, values, np.nan)
+                for name, values in _extra_columns(
+                    rng, "AreaShape_Nuclei", num_rows, extra_columns
+                ).items()
+            },
+        },
+        "edge_spots": {
+            "ImageNumber": np.where(has_edge_spot, image_numbers, np.nan),
+            "Number_Object_Number": np.where(has_edge_spot, row_number, np.nan),
+            # 0 for spots outside any nucleus, as CellProfiler does
+            "Parent_Nuclei": np.where(
+                has_edge_spot,
+                np.floor(
+                    rng.random(num_rows) * (nuclei_counts[image_index] + 1)
+                ).astype(int),
+                np.nan,
+            ),
+            **{
+                name: np.where(has_edge_spot, values, np.nan)
+                for name, values in _extra_columns(
+                    rng, "AreaShape_edge_spots", num_rows, extra_columns
+                ).items()
+            },
+        },
+    }
+    return pd.DataFrame(
+        {
+            (group, column): values
+            for group, columns in groups.items()
+            for column, values in columns.items()
+        }
+    )
+
+
+def per_nucleus_table(
+    images: pd.DataFrame,
+    nuclei_counts: np.ndarray,
+    measurements: dict,
+    extra_columns: int,
+    rng,
+) -> pd.DataFrame:
+    """Expand_Nuclei / Perinuclear_region: one row per nucleus."""
+    image_index, object_number = _object_numbers(nuclei_counts)
+    num_rows = len(image_index)
+    table = {
+        "ImageNumber": images["ImageNumber"].to_numpy()[image_index],
+        "ObjectNumber": object_number,
+        "FileName_MIRO160mer": (images["stem"] + "_MIRO160mer.tif").to_numpy()[
+            image_index
+        ],
+        "Parent_Nuclei": object_number,
+    }
+    for name, (low, high) in measurements.items():
+        table[name] = rng.uniform(low, high, num_rows).round(6)
+    table.update(_extra_columns(rng, "Intensity_Other", num_rows, extra_columns))
+    return pd.DataFrame(table)
+
+
+def write_synthetic_exports(
+    output_folder: str,
+    num_wells: int = NUM_WELLS,
+    num_xy: int = NUM_XY,
+    num_t: int = NUM_T,
+    cells_per_field: float = CELLS_PER_FIELD,
+    edge_spots_per_field: float = EDGE_SPOTS_PER_FIELD,
+    extra_columns: int = EXTRA_COLUMNS,
+    seed: int = 0,
+) -> dict[str, int]:
+    """Write the three exports for one synthetic plate to output_folder.
+
+    The number of nuclei and edge spots in each field are Poisson distributed around
+    cells_per_field and edge_spots_per_field, with at least one nucleus per field.
+
+    Returns:
+        the number of rows written to each file.
+    """
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    images = image_table(num_wells, num_xy, num_t)
+    nuclei_counts = np.maximum(rng.poisson(cells_per_field, len(images)), 1)
+    edge_spot_counts = rng.poisson(edge_spots_per_field, len(images))
+
+    tables = {
+        "All_measurements.csv": all_measurements_table(
+            images, nuclei_counts, edge_spot_counts, extra_columns, rng
+        ),
+        "Expand_Nuclei.csv": per_nucleus_table(
+            images,
+            nuclei_counts,
+            {"Intensity_MassDisplacement_MIRO160mer": (0, 3)},
+            extra_columns,
+            rng,
+        ),
+        "Perinuclear_region.csv": per_nucleus_table(
+            images,
+            nuclei_counts,
+            {
+                "Intensity_StdIntensity_MIRO160mer": (0.01, 0.05),
+                "Intensity_MeanIntensity_MIRO160mer": (0.05, 0.2),
+                "Intensity_MassDisplacement_MIRO160mer": (0, 3),
+                "GINI_Gini_MIRO160mer": (0.2, 0.8),
+            },
+            extra_columns,
+            rng,
+        ),
+    }
+    for filename, table in tables.items():
+        table.to_csv(os.path.join(output_folder, filename), index=False)
+    return {filename: len(table) for filename, table in tables.items()}
+
+
+if __name__ == "__main__":
+    row_counts = write_synthetic_exports(OUTPUT_FOLDER)
+    print(f"wrote {row_counts} to {OUTPUT_FOLDER}")
@@ -0,0 +1,22 @@
+"""
+Table helpers shared by cellprofiler_output_analyser.py and trackmate_analyser.py, so that
+neither script has to import the other.
+"""
+
+import pandas as pd
+
+
+def ragged_columns(
+    input_df: pd.DataFrame, value_column: str, columns: list[str], index_name="index"
+) -> pd.DataFrame:
+    """Put the values for each combination of `columns` side by side, padded with NaNs.
+
+    One groupby pass numbers the rows within each group, then a single pivot spreads the
+    groups into columns. Used for all the ragged tables of both analysers.
+    """
+    row_number = (
+        input_df.groupby(columns, sort=False, observed=True)
+        .cumcount()
+        .rename(index_name)
+    )
+    return input_df.set_index([row_number] + columns)[value_column].unstack(columns)
@@ -0,0 +1,631 @@
+"""
+Data processing for trackmate_analyser.ipynb, importable so that the notebook only does
+the plotting, plus the per-cell track plots (which can also be rendered in batch).
+
+Input data structure:
+
+INPUT_FOLDER
+    - date
+      - <date>_cell_orientation_coordinates.xlsx
+      - condition (no_TRAK_77 / TRAK1_79 / TRAK2_78)
+        - cell
+          - tracks.csv
+          - edges.csv
+          - spots.csv
+
+Every track is zeroed to its first frame and then rotated by the angle of its cell,
+so that all cells point in a consistent direction.
+"""
+
+import hashlib
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import matplotlib
+import numpy as np
+import pandas as pd
+import polars as pl
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+from table_utils import ragged_columns
+
+logger = logging.getLogger(__name__)
+
+CELL_KEYS = ["date", "condition", "cell"]
+TRACKMATE_FILES = ["tracks.csv", "edges.csv", "spots.csv"]
+CACHE_FOLDER = "../cache/trackmate_features"
+PLOT_FOLDER = "../plots"
+NUM_WORKERS = 8
+
+SPOT_COLS = [
+    "TRACK_ID",
+    "POSITION_X",
+    "POSITION_Y",
+    "POSITION_Z",
+    "POSITION_T",
+    "FRAME",
+]
+TRACK_COLS = [
+    "TRACK_ID",
+    "MAX_DISTANCE_TRAVELED",
+    "TRACK_MEAN_SPEED",
+    "TRACK_MAX_SPEED",
+    "TRACK_MIN_SPEED",
+    "TRACK_MEDIAN_SPEED",
+    "TRACK_STD_SPEED",
+    "MEAN_STRAIGHT_LINE_SPEED",
+    "MEAN_DIRECTIONAL_CHANGE_RATE",
+]
+
+
+def zero_positions(df: pl.DataFrame) -> pl.DataFrame:
+    df = df.sort("FRAME")
+    return df.with_columns(
+        POSITION_X_ZEROED=df["POSITION_X"] - df["POSITION_X"][0],
+        POSITION_Y_ZEROED=df["POSITION_Y"] - df["POSITION_Y"][0],
+        POSITION_T_ZEROED=df["POSITION_T"] - df["POSITION_T"][0],
+    )
+
+
+def load_cell_orientations(
+    path_to_cell_orientations: str,
+    sheet_name: str = "Sheet1",
+    condition_column: str = "condition",
+    cell_column: str = "cell",
+    angle_column: str = "angle",
+) -> Dict[Tuple[str, str], float]:
+    """Read the orientation spreadsheet for a date once, as a (condition, cell) -> angle dict.
+
+    (condition, cell) pairs that appear more than once are ambiguous and left out.
+    The older sheets use sheet_name="angles_per_cell", condition_column="Condition",
+    cell_column="Cell" and angle_column="angle (rad)".
+    """
+    cell_orientations = pl.read_excel(path_to_cell_orientations, sheet_name=sheet_name)
+    cell_orientations = cell_orientations.filter(
+        pl.len().over(condition_column, cell_column) == 1
+    )
+    return {
+        (condition, cell): angle
+        for condition, cell, angle in cell_orientations.select(
+            condition_column, cell_column, angle_column
+        ).iter_rows()
+    }
+
+
+def generate_rotated_spot_positions(
+    cell_path: str,
+    condition: str,
+    cell: str,
+    cell_orientations: Dict[Tuple[str, str], float],
+) -> Optional[pl.DataFrame]:
+    """Zero each track of a cell to its first frame, and rotate by the cell's angle."""
+    for file in TRACKMATE_FILES:
+        assert os.path.exists(os.path.join(cell_path, file))
+
+    # From tracks.csv, we need the max distance travelled.
+    tracks_df = pl.read_csv(
+        os.path.join(cell_path, "tracks.csv"), skip_rows_after_header=3
+    )
+    assert "TRACK_ID" in tracks_df.columns
+    spots_df = pl.read_csv(
+        os.path.join(cell_path, "spots.csv"), skip_rows_after_header=3
+    )
+
+    spots_df = spots_df[SPOT_COLS]
+    tracks_df = tracks_df[TRACK_COLS]
+    spots_with_max_distance = spots_df.join(
+        tracks_df, how="left", on="TRACK_ID", validate="m:1"
+    )
+    spots_with_max_distance_filtered = spots_with_max_distance.sort(
+        by=["TRACK_ID", "FRAME"]
+    )
+    if not len(spots_with_max_distance_filtered):
+        logger.warning(f"no points found for cell {cell}, condition {condition}")
+        return None
+    spots_zeroed = spots_with_max_distance_filtered.group_by("TRACK_ID").map_groups(
+        zero_positions
+    )
+    rotation_angle_rads = cell_orientations.get((condition, cell))
+    if rotation_angle_rads is None:
+        logger.warning(f"no angle found for cell {cell}, condition {condition}")
+        return None
+    spots_rotated = spots_zeroed.with_columns(
+        POSITION_X_ROTATED=pl.col("POSITION_X_ZEROED") * np.sin(rotation_angle_rads)
+        - pl.col("POSITION_Y_ZEROED") * np.cos(rotation_angle_rads),
+        POSITION_Y_ROTATED=pl.col("POSITION_X_ZEROED") * np.cos(rotation_angle_rads)
+        + pl.col("POSITION_Y_ZEROED") * np.sin(rotation_angle_rads),
+    )
+
+    return spots_rotated
+
+
+def discover_trackmate_exports(
+    root: str, dates: Optional[List[str]] = None
+) -> List[Tuple[str, str, str, str]]:
+    """Find every cell folder with a full set of TrackMate exports under root.
+
+    Expects root/date/condition/cell/{tracks,spots,edges}.csv, as in the module docstring.
+
+    Returns:
+        (date, condition, cell, cell_path) for each cell, taken from the path.
+    """
+    cells = []
+    for date in sorted(dates if dates is not None else os.listdir(root)):
+        date_path = os.path.join(root, date)
+        if not os.path.isdir(date_path):
+            continue
+        for condition in sorted(os.listdir(date_path)):
+            condition_path = os.path.join(date_path, condition)
+            if not os.path.isdir(condition_path):
+                continue
+            for cell in sorted(os.listdir(condition_path)):
+                cell_path = os.path.join(condition_path, cell)
+                if all(
+                    os.path.exists(os.path.join(cell_path, file))
+                    for file in TRACKMATE_FILES
+                ):
+                    cells.append((date, condition, cell, cell_path))
+                elif os.path.isdir(cell_path):
+                    logger.warning(f"missing TrackMate exports in {cell_path}")
+    return cells
+
+
+def read_trackmate_tables(
+    cells: List[Tuple[str, str, str, str]],
+    filename: str,
+    columns: Optional[List[str]] = None,
+) -> pl.LazyFrame:
+    """Lazily stack one TrackMate export (spots.csv, tracks.csv or edges.csv) across cells.
+
+    Nothing is read until the result is collected. Then only the requested columns are
+    parsed, and the files are read in parallel.
+
+    Args:
+        - cells: (date, condition, cell, cell_path) for each cell.
+        - filename: which export to read.
+        - columns: only read these columns. All if None.
+    Returns:
+        a lazy frame with CELL_KEYS columns added.
+    """
+    frames = []
+    for date, condition, cell, cell_path in cells:
+        # TrackMate writes three extra header rows (name, short name, units)
+        frame = pl.scan_csv(os.path.join(cell_path, filename), skip_rows_after_header=3)
+        if columns is not None:
+            frame = frame.select(columns)
+        frames.append(
+            frame.with_columns(
+                date=pl.lit(date), condition=pl.lit(condition), cell=pl.lit(cell)
+            )
+        )
+    return pl.concat(frames, how="vertical_relaxed", parallel=True)
+
+
+def orientations_to_frame(
+    cell_orientations_by_date: Dict[str, Dict[Tuple[str, str], float]]
+) -> pl.DataFrame:
+    """Stack the per-date orientation dicts into a (date, condition, cell, angle) table."""
+    return pl.DataFrame(
+        [
+            (date, condition, cell, angle)
+            for date, cell_orientations in cell_orientations_by_date.items()
+            for (condition, cell), angle in cell_orientations.items()
+        ],
+        schema={
+            "date": pl.Utf8,
+            "condition": pl.Utf8,
+            "cell": pl.Utf8,
+            "angle": pl.Float64,
+        },
+        orient="row",
+    )
+
+
+def rotate_spot_positions(
+    spots: pl.LazyFrame, orientations: pl.DataFrame
+) -> pl.LazyFrame:
+    """Zero every track to its first frame and rotate by its cell's angle, for all cells at once.
+
+    Args:
+        - spots: SPOT_COLS and TRACK_COLS for every cell, keyed by CELL_KEYS.
+        - orientations: a (date, condition, cell, angle) table, from orientations_to_frame.
+            Cells without an angle are dropped.
+    """
+    track_keys = CELL_KEYS + ["TRACK_ID"]
+    first_frame = {
+        f"{col}_ZEROED": pl.col(col)
+        - pl.col(col).sort_by("FRAME").first().over(track_keys)
+        for col in ["POSITION_X", "POSITION_Y", "POSITION_T"]
+    }
+    sin, cos = pl.col("angle").sin(), pl.col("angle").cos()
+    return (
+        spots.sort(track_keys + ["FRAME"])
+        .with_columns(**first_frame)
+        .join(orientations.lazy(), on=CELL_KEYS, how="inner")
+        .with_columns(
+            POSITION_X_ROTATED=pl.col("POSITION_X_ZEROED") * sin
+            - pl.col("POSITION_Y_ZEROED") * cos,
+            POSITION_Y_ROTATED=pl.col("POSITION_X_ZEROED") * cos
+            + pl.col("POSITION_Y_ZEROED") * sin,
+        )
+        .drop("angle")
+    )
+
+
+def generate_all_rotated_spot_positions(
+    cells: List[Tuple[str, str, str, str]],
+    cell_orientations_by_date: Dict[str, Dict[Tuple[str, str], float]],
+) -> pl.LazyFrame:
+    """Batch version of generate_rotated_spot_positions over many cells.
+
+    Args:
+        - cells: (date, condition, cell, cell_path) for each cell.
+        - cell_orientations_by_date: load_cell_orientations for each date.
+    Returns:
+        one lazy frame of rotated spots, with CELL_KEYS columns.
+    """
+    orientations = orientations_to_frame(cell_orientations_by_date)
+    missing = {cell[:3] for cell in cells} - set(
+        orientations.select(CELL_KEYS).iter_rows()
+    )
+    for date, condition, cell in sorted(missing):
+        logger.warning(
+            f"no angle found for cell {cell}, condition {condition}, date {date}"
+        )
+
+    spots_with_max_distance = read_trackmate_tables(cells, "spots.csv", SPOT_COLS).join(
+        read_trackmate_tables(cells, "tracks.csv", TRACK_COLS),
+        how="left",
+        on=CELL_KEYS + ["TRACK_ID"],
+        validate="m:1",
+    )
+    return rotate_spot_positions(spots_with_max_distance, orientations)
+
+
+def summarise_tracks(rotated_spots: pl.LazyFrame) -> pl.LazyFrame:
+    """One row per track: the TRACK_COLS statistics (lower case) and the final rotated y.
+
+    Untracked spots (no TRACK_ID) are left out, rather than grouped into one fake track.
+    """
+    return (
+        rotated_spots.filter(pl.col("TRACK_ID").is_not_null())
+        .group_by(CELL_KEYS + ["TRACK_ID"], maintain_order=True)
+        .agg(
+            *[pl.col(col).first().alias(col.lower()) for col in TRACK_COLS[1:]],
+            final_y_position=pl.col("POSITION_Y_ROTATED").sort_by("FRAME").last(),
+        )
+    )
+
+
+def join_edges_with_track_info(
+    edges: pl.LazyFrame, per_track: pl.LazyFrame
+) -> pl.LazyFrame:
+    return edges.join(
+        per_track, how="left", on=CELL_KEYS + ["TRACK_ID"], validate="m:1"
+    )
+
+
+def generate_trackmate_tables(
+    cells: List[Tuple[str, str, str, str]],
+    cell_orientations_by_date: Dict[str, Dict[Tuple[str, str], float]],
+) -> Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """Build the three tables the notebook plots from, in one go.
+
+    Returns:
+        - all rotated spots
+        - per_track: one row per track, from summarise_tracks
+        - every edge, with the information on its track
+    """
+    rotated_spots = generate_all_rotated_spot_positions(
+        cells, cell_orientations_by_date
+    ).cache()
+    per_track = summarise_tracks(rotated_spots)
+    edges_with_track_info = join_edges_with_track_info(
+        read_trackmate_tables(cells, "edges.csv"), per_track
+    )
+    # collect_all shares the common subplans and runs the queries in parallel
+    return tuple(pl.collect_all([rotated_spots, per_track, edges_with_track_info]))
+
+
+def add_edge_features(edges_with_track_info: pl.LazyFrame) -> pl.LazyFrame:
+    """The derived per-edge columns the filters work on.
+
+    Edges from cells without an angle have no rotated track to join, and are dropped, as
+    rotate_spot_positions drops their spots.
+    """
+    return (
+        edges_with_track_info.filter(pl.col("final_y_position").is_not_null())
+        .with_columns(
+            CHANGE_IN_RADS=pl.col("DIRECTIONAL_CHANGE_RATE")
+            * (pl.col("DISPLACEMENT") / pl.col("SPEED"))
+        )
+        .with_columns(
+            CHANGE_IN_DEGREES=pl.col("CHANGE_IN_RADS") * 180 / np.pi,
+            final_y_is_above_zero=pl.col("final_y_position") > 0,
+        )
+    )
+
+
+def _fingerprint(paths: List[str]) -> str:
+    """Identify a set of input files by their paths, sizes and modification times."""
+    sha = hashlib.sha256()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        sha.update(
+            f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode()
+        )
+    return sha.hexdigest()[:16]
+
+
+def load_feature_cache(
+    cells: List[Tuple[str, str, str, str]],
+    orientation_paths: Dict[str, str],
+    cache_folder: str = CACHE_FOLDER,
+) -> Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """As generate_trackmate_tables, with the edge features added, cached on disk.
+
+    The cache is keyed on every input file, so it is rebuilt whenever an export or
+    orientation sheet changes. Filtering the cached tables is then cheap.
+
+    Args:
+        - cells: (date, condition, cell, cell_path) for each cell.
+        - orientation_paths: the orientation spreadsheet for each date.
+        - cache_folder: where to keep the parquet files.
+    Returns:
+        - all rotated spots
+        - per_track
+        - every edge, with track information and add_edge_features
+    """
+    input_paths = list(orientation_paths.values()) + [
+        os.path.join(cell_path, file)
+        for *_, cell_path in cells
+        for file in TRACKMATE_FILES
+    ]
+    cache_path = os.path.join(cache_folder, _fingerprint(input_paths))
+    table_names = ["points", "per_track", "edges"]
+    if all(
+        os.path.exists(os.path.join(cache_path, f"{name}.parquet"))
+        for name in table_names
+    ):
+        logger.info(f"Reading cached features from {cache_path}")
+        return tuple(
+            pl.read_parquet(os.path.join(cache_path, f"{name}.parquet"))
+            for name in table_names
+        )
+
+    logger.info(f"Building feature cache in {cache_path}")
+    cell_orientations_by_date = {
+        date: load_cell_orientations(path) for date, path in orientation_paths.items()
+    }
+    points, per_track, edges = generate_trackmate_tables(
+        cells, cell_orientations_by_date
+    )
+    edges = add_edge_features(edges.lazy()).collect()
+    os.makedirs(cache_path, exist_ok=True)
+    for name, table in zip(table_names, [points, per_track, edges]):
+        table.write_parquet(os.path.join(cache_path, f"{name}.parquet"))
+    return points, per_track, edges
+
+
+def filter_features(
+    per_track: pl.DataFrame,
+    edges: pl.DataFrame,
+    distance_filter: float,
+    change_rate_filter: float,
+) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """Keep tracks that travel further than distance_filter, and their edges that turn
+    by less than change_rate_filter degrees."""
+    per_track_filtered = per_track.filter(
+        pl.col("max_distance_traveled") > distance_filter
+    )
+    edges_filtered = edges.filter(
+        (pl.col("max_distance_traveled") > distance_filter)
+        & (pl.col("CHANGE_IN_DEGREES") < change_rate_filter)
+    )
+    return per_track_filtered, edges_filtered
+
+
+def sweep_filter_thresholds(
+    per_track: pl.DataFrame,
+    edges: pl.DataFrame,
+    distance_filters: Sequence[float],
+    change_rate_filters: Sequence[float],
+) -> pl.DataFrame:
+    """The up/down proportions per condition for every combination of thresholds.
+
+    Equivalent to running filter_features for each (distance_filter, change_rate_filter)
+    and counting, but all thresholds are evaluated in a single pass over each table.
+
+    Returns:
+        one row per (distance_filter, change_rate_filter, condition), with the number of
+        tracks/edges kept and the proportion whose track ends above/below zero.
+    """
+    grid = list(itertools.product(distance_filters, change_rate_filters))
+    edge_counts = edges.group_by("condition").agg(
+        itertools.chain.from_iterable(
+            [
+                keep.sum().alias(f"n_{i}"),
+                (keep & pl.col("final_y_is_above_zero")).sum().alias(f"up_{i}"),
+            ]
+            for i, keep in enumerate(
+                (pl.col("max_distance_traveled") > distance_filter)
+                & (pl.col("CHANGE_IN_DEGREES") < change_rate_filter)
+                for distance_filter, change_rate_filter in grid
+            )
+        )
+    )
+    track_counts = per_track.group_by("condition").agg(
+        itertools.chain.from_iterable(
+            [
+                keep.sum().alias(f"n_{i}"),
+                (keep & (pl.col("final_y_position") > 0)).sum().alias(f"up_{i}"),
+            ]
+            for i, keep in enumerate(
+                pl.col("max_distance_traveled") > distance_filter
+                for distance_filter in distance_filters
+            )
+        )
+    )
+
+    sweeps = []
+    for i, (distance_filter, change_rate_filter) in enumerate(grid):
+        j = list(distance_filters).index(distance_filter)
+        sweeps.append(
+            edge_counts.select(
+                pl.lit(distance_filter).alias("distance_filter"),
+                pl.lit(change_rate_filter).alias("change_rate_filter"),
+                "condition",
+                n_edges=pl.col(f"n_{i}"),
+                edge_proportion_up=pl.col(f"up_{i}") / pl.col(f"n_{i}"),
+            ).join(
+                track_counts.select(
+                    "condition",
+                    n_tracks=pl.col(f"n_{j}"),
+                    track_proportion_up=pl.col(f"up_{j}") / pl.col(f"n_{j}"),
+                ),
+                on="condition",
+                how="left",
+            )
+        )
+    return (
+        pl.concat(sweeps)
+        .with_columns(
+            edge_proportion_down=1 - pl.col("edge_proportion_up"),
+            track_proportion_down=1 - pl.col("track_proportion_up"),
+        )
+        .sort(["distance_filter", "change_rate_filter", "condition"])
+    )
+
+
+def ragged_export(df: pd.DataFrame, value_column: str, by: List[str]) -> pd.DataFrame:
+    """The values of value_column for each combination of `by` side by side, padded with
+    NaNs, in one groupby pass. Columns are named by joining the group values with "_",
+    e.g. by=["condition", "final_y_is_above_zero"] gives "TRAK1_79_True".
+
+    Same shape as the tables generate_ragged_df writes in cellprofiler_output_analyser.
+    """
+    ragged_df = ragged_columns(df, value_column, by)
+    if len(by) > 1:
+        ragged_df.columns = ["_".join(map(str, key)) for key in ragged_df.columns]
+    return ragged_df.reset_index(drop=True)
+
+
+def track_segments(
+    cell_points: pd.DataFrame, distance_filter: float
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Split the points of one cell into an (n, 2) array of rotated positions per track,
+    in frame order, with a single sort rather than a query per track.
+
+    Returns:
+        - the tracks that travel further than distance_filter
+        - the rest
+        Both are empty for a cell without tracks.
+    """
+    cell_points = cell_points.dropna(subset=["TRACK_ID"]).sort_values(
+        ["TRACK_ID", "FRAME"], kind="stable"
+    )
+    if cell_points.empty:
+        return [], []
+    xy = cell_points[["POSITION_X_ROTATED", "POSITION_Y_ROTATED"]].to_numpy()
+    track_ids = cell_points["TRACK_ID"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, track_ids[1:] != track_ids[:-1]])
+    tracks = np.split(xy, starts[1:])
+    is_highlighted = (
+        cell_points["MAX_DISTANCE_TRAVELED"].to_numpy()[starts] > distance_filter
+    )
+    highlighted = [track for track, h in zip(tracks, is_highlighted) if h]
+    others = [track for track, h in zip(tracks, is_highlighted) if not h]
+    return highlighted, others
+
+
+def plot_cell_tracks(
+    ax, cell_points: pd.DataFrame, distance_filter: float, title: Optional[str] = None
+):
+    """Draw all the tracks of one cell on ax as two LineCollections: tracks that travel
+    further than distance_filter in colour, the rest in grey behind them."""
+    highlighted, others = track_segments(cell_points, distance_filter)
+    ax.add_collection(LineCollection(others, colors="grey", alpha=0.35, zorder=1))
+    colours = itertools.cycle(matplotlib.rcParams["axes.prop_cycle"].by_key()["color"])
+    ax.add_collection(
+        LineCollection(
+            highlighted,
+            colors=[next(colours) for _ in highlighted],
+            linewidths=2,
+            zorder=2,
+        )
+    )
+    ax.set_ylim(-10, 10)
+    ax.set_xlim(-8, 8)
+    ax.spines["top"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+    if title is not None:
+        ax.set_title(title, fontsize=30)
+
+
+def group_points_by_cell(
+    points: pd.DataFrame,
+) -> Dict[Tuple[str, str, str], pd.DataFrame]:
+    """All the points of each (date, condition, cell), grouped in one pass."""
+    columns = [
+        "TRACK_ID",
+        "FRAME",
+        "POSITION_X_ROTATED",
+        "POSITION_Y_ROTATED",
+        "MAX_DISTANCE_TRAVELED",
+    ]
+    return {
+        key: cell_points[columns]
+        for key, cell_points in points.groupby(CELL_KEYS, sort=False)
+    }
+
+
+def render_cell_plot(
+    key: Tuple[str, str, str],
+    cell_points: pd.DataFrame,
+    distance_filter: float,
+    output_folder: str,
+) -> str:
+    """Plot one cell to output_folder/date/condition_cell.png. Uses Figure directly rather
+    than pyplot, so it is safe to run in worker processes."""
+    date, condition, cell = key
+    fig = Figure(figsize=(10, 10))
+    ax = fig.subplots()
+    plot_cell_tracks(ax, cell_points, distance_filter, title=f"{condition} {cell}")
+    ax.set_aspect("equal")
+    ax.set_xlabel("aligned x position (µm)")
+    ax.set_ylabel("aligned y position (µm)")
+    os.makedirs(os.path.join(output_folder, date), exist_ok=True)
+    output_path = os.path.join(output_folder, date, f"{condition}_{cell}.png")
+    fig.savefig(output_path, dpi=150, bbox_inches="tight")
+    return output_path
+
+
+def render_all_cells(
+    points: pd.DataFrame,
+    distance_filter: float,
+    output_folder: str = PLOT_FOLDER,
+    num_workers: int = NUM_WORKERS,
+) -> List[str]:
+    """Plot every cell of every date to its own file, in parallel.
+
+    Returns:
+        the paths written.
+    """
+    cell_points = group_points_by_cell(points)
+    with ProcessPoolExecutor(num_workers) as executor:
+        output_paths = list(
+            executor.map(
+                render_cell_plot,
+                cell_points.keys(),
+                cell_points.values(),
+                itertools.repeat(distance_filter),
+                itertools.repeat(output_folder),
+                chunksize=4,
+            )
+        )
+    logger.info(f"wrote {len(output_paths)} cell plots to {output_folder}")
+    return output_paths
@@ -3,6 +3,8 @@
 import glob
 import os
 
+from stage_profiler import report, stage
+
 
 def calculate_average_error(file_name: str, chain="C") -> float:
     with open(file_name) as pdb_file:
@@ -34,14 +36,16 @@ if __name__ == "__main__":
         pdb_files = os.path.join(input_folder, "f*.pdb")
         for pdb_file in glob.glob(pdb_files):
             print(f"calculating score for {pdb_file}")
-            score = calculate_average_error(pdb_file)
+            with stage("read", file=pdb_file):
+                score = calculate_average_error(pdb_file)
             scores.append((pdb_file, score))
 
     # now we have the score for each file, just gotta make a csv.
-    with open(output_path, "w") as output_file:
+    with stage("write", rows=len(scores)), open(output_path, "w") as output_file:
         output_file.write("pdb_file,score\n")
         for score in scores:
             output_file.write(f"{score[0]},{score[1]}\n")
+    report(f"output_folder/{input_path}_stage_profile.json")
 
     # expecting 5 scores and 45 folders, so 225 scores
     assert len(scores) == 225
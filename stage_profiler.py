@@ -0,0 +1,180 @@
+"""
+stage_profiler.py
+
+Lightweight per-stage instrumentation for the analysis scripts. Wrap each stage of a run
+(read, extract, aggregate, pivot, write, plot...) in `stage`, or decorate a function with
+`profiled`, and every call records:
+
+- wall time and CPU time
+- the number of rows processed, if given
+- the peak RSS of the process at the end of the stage, and how much the stage raised
+  that high-water mark (zero for a stage that stays below an earlier peak)
+- the change in the current RSS over the stage, where /proc is available (Linux)
+
+At the end of the run, `report` writes the records as JSON and prints a summary per stage,
+slowest first:
+
+    from stage_profiler import report, stage
+
+    with stage("read") as record:
+        df = pd.read_csv(path)
+        record["rows"] = len(df)
+    ...
+    report("output_folder/stage_profile.json")
+"""
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional
+
+RECORDS: List[Dict[str, object]] = []
+_STARTED = datetime.now().isoformat(timespec="seconds")
+_open_stages: List[str] = []
+
+
+def peak_rss_mb() -> float:
+    """The peak resident set size of this process so far, in MB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def current_rss_mb() -> Optional[float]:
+    """The current resident set size of this process, in MB. None without /proc/self/statm,
+    e.g. on macOS."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+@contextmanager
+def stage(name: str, rows: Optional[int] = None, **details) -> Iterator[dict]:
+    """Record the wall time, CPU time and peak memory of the enclosed block.
+
+    Args:
+        - name: the stage, e.g. "read". Records are summarised by name.
+        - rows: the number of rows processed. Can also be set on the yielded record, for
+            when it is only known at the end of the stage.
+        - details: anything else to keep in the JSON record, e.g. the file name.
+    Yields:
+        the record, as a dict.
+    """
+    record = {
+        "stage": name,
+        "parent": _open_stages[-1] if _open_stages else None,
+        "rows": rows,
+        **details,
+    }
+    _open_stages.append(name)
+    high_water_before, rss_before = peak_rss_mb(), current_rss_mb()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_s"] = time.perf_counter() - wall_start
+        record["cpu_s"] = time.process_time() - cpu_start
+        record["peak_rss_mb"] = peak_rss_mb()
+        # ru_maxrss only ever grows, so this is how much the stage raised the peak so
+        # far, not how much memory it used
+        record["high_water_mark_increase_mb"] = (
+            record["peak_rss_mb"] - high_water_before
+        )
+        rss_after = current_rss_mb()
+        record["rss_change_mb"] = (
+            rss_after - rss_before
+            if rss_before is not None and rss_after is not None
+            else None
+        )
+        _open_stages.pop()
+        RECORDS.append(record)
+
+
+def profiled(name: Optional[str] = None, rows: Optional[Callable] = None):
+    """Decorator version of `stage`, named after the function unless given a name.
+
+    Args:
+        - rows: called on the return value to count the rows processed, e.g. rows=len.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__) as record:
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    record["rows"] = rows(result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def summarise(records: List[Dict[str, object]] = RECORDS) -> List[Dict[str, object]]:
+    """Total the records of each stage, sorted by total wall time, slowest first."""
+    totals: Dict[str, Dict[str, object]] = {}
+    for record in records:
+        total = totals.setdefault(
+            record["stage"],
+            {
+                "stage": record["stage"],
+                "calls": 0,
+                "wall_s": 0.0,
+                "cpu_s": 0.0,
+                "rows": 0,
+                "peak_rss_mb": 0.0,
+            },
+        )
+        total["calls"] += 1
+        total["wall_s"] += record["wall_s"]
+        total["cpu_s"] += record["cpu_s"]
+        total["rows"] += record["rows"] or 0
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+    return sorted(totals.values(), key=lambda total: total["wall_s"], reverse=True)
+
+
+def print_summary(records: List[Dict[str, object]] = RECORDS):
+    print(
+        f"{'stage':<24}{'calls':>7}{'wall (s)':>11}{'cpu (s)':>11}"
+        f"{'rows':>12}{'rows/s':>12}{'peak RSS (MB)':>15}"
+    )
+    for total in summarise(records):
+        rows_per_s = total["rows"] / total["wall_s"] if total["wall_s"] else 0
+        print(
+            f"{total['stage']:<24}{total['calls']:>7}{total['wall_s']:>11.3f}"
+            f"{total['cpu_s']:>11.3f}{total['rows']:>12}{rows_per_s:>12.0f}"
+            f"{total['peak_rss_mb']:>15.1f}"
+        )
+
+
+def write_report(output_path: str, records: List[Dict[str, object]] = RECORDS):
+    """Write the records of this run, and their summary, as JSON."""
+    output_folder = os.path.dirname(output_path)
+    if output_folder and not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    run_report = {
+        "script": os.path.basename(sys.argv[0]),
+        "started": _STARTED,
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "peak_rss_mb": peak_rss_mb(),
+        "summary": summarise(records),
+        "stages": records,
+    }
+    with open(output_path, "w") as f:
+        json.dump(run_report, f, indent=2, default=str)
+
+
+def report(output_path: Optional[str] = None):
+    """At the end of a run: write the JSON report if given a path, and print the summary."""
+    if output_path is not None:
+        write_report(output_path)
+        print(f"stage profile written to {output_path}")
+    print_summary()
@@ -0,0 +1,204 @@
+"""
+structure_batch_summariser.py
+
+For every predicted model in a batch of prediction folders, make a single pass over the
+structure file and its score json and compute:
+
+- the mean pLDDT for each chain (one value per residue, as in pdb_aggregator.py)
+- the mean PAE between every pair of chains, from block reductions on the PAE matrix
+- ipTM and pTM
+
+and write a single table per batch, one row per model, ranked by ipTM (then pTM).
+
+Expects ColabFold-style output:
+
+INPUT_FOLDER/BATCH
+    - folder1
+      - <name>_unrelaxed_rank_001_..._model_1_seed_000.pdb
+      - <name>_scores_rank_001_..._model_1_seed_000.json
+      ...
+
+AlphaFold3 server output (<name>_model_0.cif, <name>_full_data_0.json,
+<name>_summary_confidences_0.json) is also understood.
+"""
+import glob
+import json
+import logging
+import os
+import re
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# ----------- CHANGE HERE ---------------
+INPUT_FOLDER = "input_folder"
+BATCHES = ["230713"]
+OUTPUT_FOLDER = "output_folder"
+# relative to INPUT_FOLDER/BATCH. Use "*/*.cif" for AF3 output.
+STRUCTURE_GLOB = "*/*.pdb"
+NUM_WORKERS = 8
+# ---------------------------------------
+
+
+def read_pdb_plddts(pdb_path: str) -> Tuple[List[str], List[np.ndarray]]:
+    """Read the per-residue pLDDT for each chain in a pdb file, in file order.
+
+    Like pdb_aggregator.calculate_average_error, takes the B-factor of the first atom of
+    each residue, but reads every chain in one pass. Only ATOM records are read: ligands
+    and waters (HETATM) have no PAE rows in the ColabFold scores, so counting them would
+    break the per-chain PAE blocks.
+
+    Returns:
+        - chain names, in order of appearance
+        - a per-residue pLDDT array for each chain
+    """
+    chains: Dict[str, List[float]] = {}
+    last_residue: Dict[str, str] = {}
+    with open(pdb_path) as pdb_file:
+        for line in pdb_file:
+            if not line.startswith("ATOM"):
+                continue
+            chain = line[21]
+            residue = line[22:27]  # residue number + insertion code
+            if last_residue.get(chain) == residue:
+                continue
+            last_residue[chain] = residue
+            chains.setdefault(chain, []).append(float(line[60:66]))
+    return list(chains), [np.asarray(v) for v in chains.values()]
+
+
+def read_cif_plddts(cif_path: str) -> Tuple[List[str], List[np.ndarray]]:
+    """As read_pdb_plddts, for mmCIF files (first model only).
+
+    Only ATOM residues are read, as in read_pdb_plddts: ligands, ions and waters are left
+    out, and so are chains with nothing else (e.g. an AlphaFold3 ligand chain).
+    """
+    import gemmi  # only needed for cif input
+
+    structure = gemmi.read_structure(cif_path)
+    names, plddts = [], []
+    for chain in structure[0]:
+        chain_plddts = [
+            residue[0].b_iso for residue in chain if residue.het_flag == "A"
+        ]
+        if chain_plddts:
+            names.append(chain.name)
+            plddts.append(np.array(chain_plddts))
+    return names, plddts
+
+
+def find_score_files(structure_path: str) -> List[str]:
+    """Find the json files holding the scores (PAE, ipTM, pTM) for a structure file."""
+    folder, filename = os.path.split(structure_path)
+    stem = os.path.splitext(filename)[0]
+    if re.search(r"_(un)?relaxed_", stem):
+        # ColabFold: x_unrelaxed_rank_001_..._model_1_seed_000 -> x_scores_rank_001_...
+        candidates = [re.sub(r"_(un)?relaxed_", "_scores_", stem, count=1) + ".json"]
+    else:
+        # AlphaFold3: x_model_0 -> x_full_data_0, x_summary_confidences_0
+        match = re.search(r"^(.*)_model_(\d+)$", stem)
+        if match is None:
+            return []
+        name, index = match.groups()
+        candidates = [
+            f"{name}_full_data_{index}.json",
+            f"{name}_summary_confidences_{index}.json",
+        ]
+    paths = [os.path.join(folder, candidate) for candidate in candidates]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def block_mean_pae(pae: np.ndarray, chain_lengths: List[int]) -> np.ndarray:
+    """Reduce an (N, N) PAE matrix to a (n_chains, n_chains) matrix of block means.
+
+    Entry (i, j) is the mean expected error in chain j when aligned on chain i.
+    """
+    lengths = np.asarray(chain_lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    block_sums = np.add.reduceat(np.add.reduceat(pae, starts, axis=0), starts, axis=1)
+    return block_sums / np.outer(lengths, lengths)
+
+
+def summarise_model(structure_path: str) -> Dict[str, object]:
+    """Compute all the per-model summary statistics in one pass over its files."""
+    if structure_path.endswith(".cif"):
+        chain_names, plddts = read_cif_plddts(structure_path)
+    else:
+        chain_names, plddts = read_pdb_plddts(structure_path)
+
+    scores: Dict[str, object] = {}
+    for score_path in find_score_files(structure_path):
+        with open(score_path) as f:
+            scores.update(json.load(f))
+
+    summary: Dict[str, object] = {
+        "model": os.path.splitext(os.path.basename(structure_path))[0],
+        "folder": os.path.basename(os.path.dirname(structure_path)),
+        "iptm": scores.get("iptm", np.nan),
+        "ptm": scores.get("ptm", np.nan),
+        "mean_plddt": np.concatenate(plddts).mean() if plddts else np.nan,
+    }
+    for chain_name, chain_plddt in zip(chain_names, plddts):
+        summary[f"plddt_{chain_name}"] = chain_plddt.mean()
+
+    if "pae" not in scores:
+        logger.warning(f"No PAE found for {structure_path}")
+        return summary
+    pae = np.asarray(scores["pae"], dtype=float)
+    chain_lengths = [len(chain_plddt) for chain_plddt in plddts]
+    if pae.shape != (sum(chain_lengths),) * 2:
+        logger.warning(
+            f"PAE shape {pae.shape} does not match {sum(chain_lengths)} residues in {structure_path}"
+        )
+        return summary
+
+    block_means = block_mean_pae(pae, chain_lengths)
+    inter_chain_sum, inter_chain_count = 0.0, 0
+    for i, chain_i in enumerate(chain_names):
+        for j in range(i + 1, len(chain_names)):
+            # both off-diagonal blocks have the same size, so their mean is the pair mean
+            summary[f"pae_{chain_i}_{chain_names[j]}"] = (
+                block_means[i, j] + block_means[j, i]
+            ) / 2
+            block_size = chain_lengths[i] * chain_lengths[j]
+            inter_chain_sum += (block_means[i, j] + block_means[j, i]) * block_size
+            inter_chain_count += 2 * block_size
+    summary["mean_interchain_pae"] = (
+        inter_chain_sum / inter_chain_count if inter_chain_count else np.nan
+    )
+    return summary
+
+
+def summarise_batch(
+    structure_paths: List[str], num_workers: int = NUM_WORKERS
+) -> pd.DataFrame:
+    """Summarise every model in a batch, and rank by ipTM, then pTM."""
+    with Pool(num_workers) as p:
+        summaries = p.map(summarise_model, structure_paths, chunksize=4)
+    summary_df = pd.DataFrame(summaries)
+    if summary_df.empty:
+        return summary_df
+    summary_df = summary_df.sort_values(
+        ["iptm", "ptm"], ascending=False, na_position="last"
+    ).reset_index(drop=True)
+    summary_df.insert(0, "rank", np.arange(1, len(summary_df) + 1))
+    return summary_df
+
+
+if __name__ == "__main__":
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+    for batch in BATCHES:
+        structure_paths = sorted(
+            glob.glob(os.path.join(INPUT_FOLDER, batch, STRUCTURE_GLOB))
+        )
+        logger.info(f"Summarising {len(structure_paths)} models in {batch}")
+        summary_df = summarise_batch(structure_paths)
+        output_path = os.path.join(OUTPUT_FOLDER, f"{batch}_summary.csv")
+        logger.info(f"Writing summary with shape {summary_df.shape} to {output_path}")
+        summary_df.to_csv(output_path, index=False)
@@ -0,0 +1,181 @@
+"""
+synthetic_structures.py
+
+Write synthetic prediction output for benchmarking the structure scripts without real
+predictions: a multi-chain model as PDB and mmCIF, and a ColabFold score json, e.g.
+
+OUTPUT_FOLDER
+    - synthetic_unrelaxed_rank_001_alphafold2_multimer_v3_model_1_seed_000.pdb
+    - synthetic_scores_rank_001_alphafold2_multimer_v3_model_1_seed_000.json
+    - synthetic_model_0.cif
+
+The chains are called A, B, C... Each residue has ATOMS_PER_RESIDUE atoms, placed along
+a random walk, with the per-residue pLDDT as the B-factor of all its atoms. The PAE is
+low within chains and high between them, as in a typical multimer prediction.
+"""
+import json
+import os
+import string
+from typing import Dict, List
+
+import numpy as np
+
+# ----------- CHANGE HERE ---------------
+OUTPUT_FOLDER = "synthetic_structures"
+NUM_RESIDUES = 1000  # in total, split evenly between the chains
+NUM_CHAINS = 4
+ATOMS_PER_RESIDUE = 8
+# ---------------------------------------
+
+ATOM_NAMES = ["N", "CA", "C", "O", "CB", "CG", "CD", "CE", "NZ", "OG", "SD", "OD1"]
+MODEL_SUFFIX = "rank_001_alphafold2_multimer_v3_model_1_seed_000"
+
+
+def chain_lengths(num_residues: int, num_chains: int) -> List[int]:
+    """Split num_residues as evenly as possible between num_chains chains."""
+    return [
+        num_residues // num_chains + (i < num_residues % num_chains)
+        for i in range(num_chains)
+    ]
+
+
+def synthetic_model(
+    lengths: List[int], atoms_per_residue: int, seed: int = 0
+) -> Dict[str, np.ndarray]:
+    """One row per atom: chain index, residue number within the chain, atom index within
+    the residue, coordinates and B-factor (the pLDDT of the residue)."""
+    rng = np.random.default_rng(seed)
+    num_residues = sum(lengths)
+    chain_index = np.repeat(np.arange(len(lengths)), lengths)
+    residue_number = np.concatenate([np.arange(1, length + 1) for length in lengths])
+    plddt = np.clip(rng.normal(80, 12, num_residues), 20, 98.9).round(2)
+    ca_trace = np.cumsum(rng.normal(0, 2.2, (num_residues, 3)), axis=0)
+    atoms = np.repeat(np.arange(num_residues), atoms_per_residue)
+    return {
+        "chain_index": chain_index[atoms],
+        "residue_number": residue_number[atoms],
+        "atom_index": np.tile(np.arange(atoms_per_residue), num_residues),
+        "xyz": ca_trace[atoms] + rng.normal(0, 1, (len(atoms), 3)),
+        "b_factor": plddt[atoms],
+        "plddt": plddt,
+    }
+
+
+def write_pdb(path: str, model: Dict[str, np.ndarray]):
+    """ColabFold-style pdb: one MODEL line, the atoms, then TER, ENDMDL, END."""
+    lines = ["MODEL        1\n"]
+    for serial, (chain, residue, atom, (x, y, z), b_factor) in enumerate(
+        zip(
+            model["chain_index"],
+            model["residue_number"],
+            model["atom_index"],
+            model["xyz"],
+            model["b_factor"],
+        ),
+        start=1,
+    ):
+        name = ATOM_NAMES[atom % len(ATOM_NAMES)]
+        lines.append(
+            f"ATOM  {serial % 100000:5d}  {name:<3} ALA {string.ascii_uppercase[chain]}"
+            f"{residue:4d}    {x:8.3f}{y:8.3f}{z:8.3f}  1.00{b_factor:6.2f}"
+            f"           {name[0]}  \n"
+        )
+    lines += ["TER\n", "ENDMDL\n", "END\n"]
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def write_cif(path: str, model: Dict[str, np.ndarray]):
+    """A minimal mmCIF with the _atom_site loop, as in AlphaFold3 output."""
+    columns = [
+        "group_PDB",
+        "id",
+        "type_symbol",
+        "label_atom_id",
+        "label_alt_id",
+        "label_comp_id",
+        "label_asym_id",
+        "label_entity_id",
+        "label_seq_id",
+        "pdbx_PDB_ins_code",
+        "Cartn_x",
+        "Cartn_y",
+        "Cartn_z",
+        "occupancy",
+        "B_iso_or_equiv",
+        "auth_seq_id",
+        "auth_asym_id",
+        "pdbx_PDB_model_num",
+    ]
+    lines = ["data_synthetic\n", "#\n", "loop_\n"]
+    lines += [f"_atom_site.{column}\n" for column in columns]
+    for serial, (chain, residue, atom, (x, y, z), b_factor) in enumerate(
+        zip(
+            model["chain_index"],
+            model["residue_number"],
+            model["atom_index"],
+            model["xyz"],
+            model["b_factor"],
+        ),
+        start=1,
+    ):
+        name = ATOM_NAMES[atom % len(ATOM_NAMES)]
+        chain_name = string.ascii_uppercase[chain]
+        lines.append(
+            f"ATOM {serial} {name[0]} {name} . ALA {chain_name} {chain + 1} {residue} ? "
+            f"{x:.3f} {y:.3f} {z:.3f} 1.00 {b_factor:.2f} {residue} {chain_name} 1\n"
+        )
+    lines.append("#\n")
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def write_scores_json(path: str, lengths: List[int], plddt: np.ndarray, seed: int = 0):
+    """ColabFold scores: plddt, pae (N x N), max_pae, ptm and iptm."""
+    rng = np.random.default_rng(seed)
+    chain_index = np.repeat(np.arange(len(lengths)), lengths)
+    same_chain = chain_index[:, None] == chain_index[None, :]
+    pae = np.where(same_chain, 4.0, 18.0) + rng.gamma(2.0, 1.5, same_chain.shape)
+    pae = np.clip(pae, 0, 31.75).round(2)
+    scores = {
+        "plddt": plddt.tolist(),
+        "pae": pae.tolist(),
+        "max_pae": 31.75,
+        "ptm": round(float(rng.uniform(0.4, 0.9)), 2),
+        "iptm": round(float(rng.uniform(0.2, 0.9)), 2),
+    }
+    with open(path, "w") as f:
+        json.dump(scores, f)
+
+
+def write_synthetic_prediction(
+    output_folder: str,
+    num_residues: int = NUM_RESIDUES,
+    num_chains: int = NUM_CHAINS,
+    atoms_per_residue: int = ATOMS_PER_RESIDUE,
+    name: str = "synthetic",
+    seed: int = 0,
+) -> Dict[str, str]:
+    """Write the pdb, cif and score json of one synthetic prediction.
+
+    Returns:
+        the path of each file, keyed by "pdb", "cif" and "json".
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    lengths = chain_lengths(num_residues, num_chains)
+    model = synthetic_model(lengths, atoms_per_residue, seed)
+    paths = {
+        "pdb": os.path.join(output_folder, f"{name}_unrelaxed_{MODEL_SUFFIX}.pdb"),
+        "cif": os.path.join(output_folder, f"{name}_model_0.cif"),
+        "json": os.path.join(output_folder, f"{name}_scores_{MODEL_SUFFIX}.json"),
+    }
+    write_pdb(paths["pdb"], model)
+    write_cif(paths["cif"], model)
+    write_scores_json(paths["json"], lengths, model["plddt"], seed)
+    return paths
+
+
+if __name__ == "__main__":
+    paths = write_synthetic_prediction(OUTPUT_FOLDER)
+    print(f"wrote {list(paths.values())}")